@@ -5,12 +5,14 @@ import pdb
 import numpy as np
 import scipy.misc as sm
 import scipy.signal
+import scipy.sparse
 from scipy import stats
 from scipy import spatial
 import math
 import scipy.ndimage.filters as snf
 import os
 import time
+import hashlib
 from numpy import unravel_index
 reload(opt)
 
@@ -49,9 +51,125 @@ def buildS1filters():
 			myfilt = myfilt / np.sqrt(np.sum(myfilt**2))
 			filtsthissize.append(myfilt.astype('float'))
 		filts.append(filtsthissize)
-	return filts
+	return S1FilterBank(filts)
 
-def runC1layer(S1outputs):
+class S1FilterBank(list):
+	"""
+	The list of lists of S1 filters returned by buildS1filters(), together
+	with the spectra of these filters. It can be used anywhere the plain list
+	is expected. 
+
+	For each input image shape, the spectra of all the filters (zero-padded to
+	that shape) are computed once and cached, so that runS1layer() only has to
+	transform the image itself, and can then obtain the responses of all
+	scales and orientations with a single batched inverse FFT.
+	"""
+
+	def __init__(self, filts):
+		list.__init__(self, filts)
+		self.spectra = {}
+
+	def digest(self):
+		'''
+		Hash of the filters, and of the options that affect the C1 output
+		'''
+		h = hashlib.sha1()
+		for fthisscale in self:
+			for filt in fthisscale:
+				h.update(repr(filt.shape))
+				h.update(np.ascontiguousarray(filt, dtype=float).tostring())
+		h.update(repr((opt.SIGMAS1, opt.C1RFSIZE)))
+		return h.hexdigest()
+
+	def getSpectra(self, shape):
+		'''
+		Input: the (x, y) shape of the images to be filtered
+		Output: complex array, NBS1SCALES x 4 x rfft2 shape
+		'''
+		shape = tuple(shape)
+		if shape not in self.spectra:
+			padded = np.zeros((len(self), len(self[0])) + shape)
+			for scaleidx, fthisscale in enumerate(self):
+				RFSIZE = fthisscale[0].shape[0]
+				for o, filt in enumerate(fthisscale):
+					# Same truncation as np.fft.rfft2(filt, shape)
+					filt = filt[:shape[0], :shape[1]]
+					padded[scaleidx, o, :filt.shape[0], :filt.shape[1]] = filt
+				# Rolling the padded filter centers it on the origin, which is
+				# the same as rolling the output of the fft convolution by 
+				# -(RFSIZE/2) (fun fact: -N/2 != -(N/2) ...)
+				padded[scaleidx] = np.roll(np.roll(padded[scaleidx], -(RFSIZE/2), axis=2), -(RFSIZE/2), axis=1)
+			self.spectra[shape] = np.fft.rfft2(padded)
+		return self.spectra[shape]
+
+	def getResponses(self, img, scales=None):
+		'''
+		Input: n x n img (float), or a stack of them (... x n x n), and 
+		optionally the indices of the scales that are needed (default: all)
+		Output: ... x len(scales) x 4 x n x n array of raw (unnormalized)
+		filter responses
+		'''
+		shape = img.shape[-2:]
+		spectra = self.getSpectra(shape)
+		if scales is not None:
+			spectra = spectra[scales]
+		imgspectrum = np.fft.rfft2(img)[..., np.newaxis, np.newaxis, :, :]
+		return np.fft.irfft2(spectra * imgspectrum, s=shape)
+
+	def getStridedResponses(self, img, scaleidx, stride):
+		'''
+		Same responses as getResponses(img)[..., scaleidx, :, ::stride, ::stride], 
+		but computed by direct cross-correlation at the kept positions only.
+		Output: ... x ceil(n/stride) x ceil(n/stride) x 4 array 
+		'''
+		fthisscale = self[scaleidx]
+		RFSIZE = fthisscale[0].shape[0]
+		# The fft convolution wraps around the borders, and its output is
+		# rolled by RFSIZE/2; since it is a convolution, the filters are flipped
+		padwidth = [(0, 0)] * (img.ndim - 2) + [(RFSIZE-1-RFSIZE/2, RFSIZE/2)] * 2
+		padded = np.pad(img, padwidth, mode='wrap')
+		windows = stridedWindows(padded, RFSIZE, stride, img.shape)
+		filts = np.array([filt[::-1, ::-1] for filt in fthisscale])
+		return np.tensordot(windows, filts, axes=([-2, -1], [1, 2]))
+
+def stridedWindows(padded, size, stride, shape):
+	'''
+	Read-only view of the size x size windows of padded 2D maps (the last two
+	axes), whose top-left corners are every stride-th position of the original
+	maps of the given shape.
+	Output: ... x ceil(x/stride) x ceil(y/stride) x size x size 
+	'''
+	outshape = ((shape[-2]-1)/stride + 1, (shape[-1]-1)/stride + 1)
+	s0, s1 = padded.strides[-2:]
+	return np.lib.stride_tricks.as_strided(padded, 
+		shape=padded.shape[:-2] + outshape + (size, size),
+		strides=padded.strides[:-2] + (stride*s0, stride*s1, s0, s1))
+
+def stridedBoxSum(imgsq, RFSIZE, stride):
+	'''
+	Same as (snf.uniform_filter(imgsq, RFSIZE)*RFSIZE*RFSIZE)[::stride,::stride]
+	(including its 'reflect' borders), computed at the kept positions only.
+	Leading axes, if any, are treated as a stack of 2D maps.
+	'''
+	padwidth = [(0, 0)] * (imgsq.ndim - 2) + [(RFSIZE/2, RFSIZE-1-RFSIZE/2)] * 2
+	padded = np.pad(imgsq, padwidth, mode='symmetric')
+	return stridedWindows(padded, RFSIZE, stride, imgsq.shape).sum(axis=(-2, -1))
+
+def s1UseFFT(shape, RFSIZE, stride):
+	'''
+	Cost model of the 'strided' S1 mode. The direct strided cross-correlation
+	costs RFSIZE^2 multiply-adds per kept sample, while the fft convolution 
+	costs about log2(n*n) per input pixel, whether it is kept or not.
+	Filters larger than the image always use the fft convolution: it 
+	truncates them to the image (see S1FilterBank.getSpectra()), which the 
+	wrap-padded direct cross-correlation does not.
+	'''
+	if RFSIZE > min(shape):
+		return True
+	nbkept = ((shape[0]-1)/stride + 1) * ((shape[1]-1)/stride + 1)
+	return nbkept * RFSIZE * RFSIZE > opt.S1FFTCOST * shape[0] * shape[1] * np.log2(shape[0] * shape[1])
+
+def runC1layer(S1outputs, c1grid=False):
 	"""
 	Used for both C1, C2b and C3 layers.
 	Input: A stack of 4 2D maps (one per orientation) for each scale (there are 12 scales)
@@ -60,90 +178,114 @@ def runC1layer(S1outputs):
 			Note only one RF is used: 9 x 9
 			Therefore output is 4 2D maps (one per orientation) for each scale.
 			The scales are not merged UNLIKE HMAX.
+	If c1grid is True, the S1 maps only contain the samples read by C1 (see
+	runS1layer()), and are not subsampled again. Scales for which S1 was not
+	computed (None) are skipped.
 	"""
 	
 	# print "Run C1 layer"
-  
 	output = []
-	for k in range(0, len(S1outputs)):
-		wdt,hgt,numOrient = S1outputs[k].shape
-		#print 'C1 input shape: ', S1outputs[k].shape
-		out = []
-		for p in range(numOrient):
-			img = S1outputs[k][:,:,p]
-			img = img[::2,::2] #my interpretation of page5 column2, paragraph2 "positioned over every other column... "
-			result = snf.maximum_filter(img, size= opt.C1RFSIZE)
-			#print 'C1 output shape: ', result.shape
-			out.append(result)
-		output.append(np.dstack(out[:]))
+	for S1thisscale in S1outputs:
+		if S1thisscale is None:
+			output.append(None)
+			continue
+		#print 'C1 input shape: ', S1thisscale.shape
+		if not c1grid:
+			S1thisscale = S1thisscale[::2, ::2, :] #my interpretation of page5 column2, paragraph2 "positioned over every other column... "
+		# Max over x and y only, for all orientations at once
+		output.append(snf.maximum_filter(S1thisscale, size=(opt.C1RFSIZE, opt.C1RFSIZE, 1)))
 
 	# print 'C1 layer shape: ', len(output), output[0].shape
 	return output
-	
 
-def runS1layer(imgin, s1f):
+def runS1C1layers(imgin, s1f, mode=None, scales=None):
+	'''
+	Same as runC1layer(runS1layer(imgin, s1f, mode, scales=scales)), except
+	that the S1 samples discarded by C1 are never computed. Use it whenever
+	the S1 maps themselves are not needed.
+	'''
+	return runC1layer(runS1layer(imgin, s1f, mode, c1grid=True, scales=scales), c1grid=True)
+
+def runS1layer(imgin, s1f, mode=None, c1grid=False, scales=None):
 	'''
 	Input: n x n img
 	Output: 4D arrays, 12 (one per scale) 4 (one per orientation) 2D maps 
+
+	mode (default: opt.S1MODE) is either 'fft', which computes full-resolution
+	maps and then applies the stride, or 'strided', which only computes the
+	samples that are kept, using direct cross-correlation for small RFs and
+	fft convolution for large ones (see s1UseFFT()).
+	If c1grid is True, only every other row and column of the output is
+	computed, i.e. the samples actually read by runC1layer(..., c1grid=True).
+	If scales (a list of scale indices) is given, only these scales are
+	computed, and the others are None (see requiredScales()).
 	'''
 	# print "Running S1 layer"
+	if mode is None:
+		mode = opt.S1MODE
+	if mode not in ['fft', 'strided']:
+		raise ValueError('Unknown S1 mode: ' + str(mode))
 	img = imgin.astype(float)
 	# print 'Input shape: ', img.shape
-	output=[]
+	shape = img.shape
+	if not isinstance(s1f, S1FilterBank):
+		s1f = S1FilterBank(s1f)
+	# We assume that at any given scale, all the filters have the same RF size,
+	# and so the RF size is simply the x-size of the filter at the 1st orientation
+	# (note that all RFs are assumed square).
+	RFSIZES = [fthisscale[0].shape[0] for fthisscale in s1f]
+	strides = [int(np.round(RFSIZE/4.0)) for RFSIZE in RFSIZES]
+	if c1grid:
+		strides = [2 * stride for stride in strides]
+	if scales is None:
+		scales = range(len(s1f))
+	fftscales = [scaleidx for scaleidx in scales if mode == 'fft' 
+		or s1UseFFT(shape, RFSIZES[scaleidx], strides[scaleidx])]
+	# fft convolution of the image with all the filters at once; note
+	# that in the case of S1 filters, reversing the filters seems to have
+	# no effect, so convolution = cross-correlation (...?)
+	responses = {}
+	if len(fftscales) > 0:
+		responses = dict(zip(fftscales, s1f.getResponses(img, fftscales)))
 	imgsq = img**2
-	cpt=0
+	output = [None] * len(s1f)
 	# Each element in s1f is the set of filters (of various orientations) for a
 	# particular scale. We also use the index of this scale for debugging
 	# purposes in an assertion.
-
-	for scaleidx, fthisscale in enumerate(s1f):
-		# We assume that at any given scale, all the filters have the same RF size,
-		# and so the RF size is simply the x-size of the filter at the 1st orientation
-		# (note that all RFs are assumed square).
-		#sprint 'Shape of S1 filter: ', fthisscale[0].shape 
-		RFSIZE = fthisscale[0].shape[0]
+	for scaleidx in scales:
+		RFSIZE = RFSIZES[scaleidx]
 		assert RFSIZE == opt.S1RFSIZES[scaleidx]
-		stride = int(np.round(RFSIZE/4.0))
-		# print 'Stride is: ', stride, ' and output shape is: ', img.shape[0]/stride
-		outputsAllOrient = []
+		# Striding is performed according to page 5 of Miconi et al
+		stride = strides[scaleidx]
 		# The output of every S1 neuron is divided by the
 		# Euclidan norm (root-sum-squares) of its inputs; also, we take the
 		# absolute value.
 		# As seen in J. Mutch's hmin and Riesenhuber-Serre-Bileschi code.
 		# Perhaps a SIGMA in the denominator would be good here?...
 		# Though it might need to be adjusted for filter size...
-		tmp = snf.uniform_filter(imgsq, RFSIZE)*RFSIZE*RFSIZE
-		#tmp = tmp[::stride,::stride] #subsample according to Page5 Miconi et al
-		#print 'Size of tmp: ', tmp.shape
+		# Only the samples we keep need to be normalized.
+		if mode == 'fft':
+			tmp = snf.uniform_filter(imgsq, RFSIZE)*RFSIZE*RFSIZE
+			tmp = tmp[::stride, ::stride]
+		else:
+			tmp = stridedBoxSum(imgsq, RFSIZE, stride)
 		tmp[tmp<0]=0.0
 		normim = np.sqrt(tmp) + 1e-9 + opt.SIGMAS1
 		assert np.min(normim>0)
-		for o in range(0,4):
-			# fft convolution; note that in the case of S1 filters, reversing
-			# the filters seems to have no effect, so convolution =
-			# cross-correlation (...?)
-			tmp = np.fft.irfft2(np.fft.rfft2(img) * np.fft.rfft2(fthisscale[o], img.shape))
-			# Using the fft convolution requires the following (fun fact: -N/2 != -(N/2) ...)
-			tmp =np.roll(np.roll(tmp,-(RFSIZE/2), axis=1),-(RFSIZE/2), axis=0)
-			# Normalization
-			tmp  /= (normim)
-			# crop the border of conv output
-			fin = np.abs(tmp[RFSIZE/2:-RFSIZE/2, RFSIZE/2:-RFSIZE/2])
-			fin = tmp[::stride,::stride] #perform striding according to page 5 of Miconi et al (might be a more efficient way to do this)
-			
-			# assert np.max(fin) < 1
-			#print 'Output shape on S1 filter: ', fin.shape
-			outputsAllOrient.append(fin)
-		# We stack together the orientation maps of all 4 orientations into one single
-		# 3D array, for each scale/RF size.
-		output.append(np.dstack(outputsAllOrient[:]));
-		cpt += 1
+		if scaleidx in responses:
+			# The orientation maps of all 4 orientations are stacked into 
+			# the last axis, for each scale/RF size
+			fin = np.rollaxis(responses[scaleidx][:, ::stride, ::stride], 0, 3)
+		else:
+			fin = s1f.getStridedResponses(img, scaleidx, stride)
+		# assert np.max(fin) < 1
+		output[scaleidx] = np.ascontiguousarray(fin / normim[..., np.newaxis])
 
-		
 	return output
 
+
 def extractS3Vector(output):
-	numScales = range(len(output))[0:3]
+	numScales = range(len(output))[0:opt.NBS3SCALES]
 	selectedScale = random.choice(numScales)
 	print 'S3 Selected SCALE is: ', selectedScale
 	Cchoice = output[selectedScale]
@@ -204,7 +346,38 @@ def extract3DPatch(output, nbkeptweights):
 	prot.flat[zeroedweights] = -1
 	return prot
 
-def myNormCrossCorr(stack, prot):
+def extract3DPatches(output, scales, positions, permutations, nbkeptweights):
+	'''
+	Extracts many patches at once, each one as extract3DPatch() does, but
+	from given draws
+	Input: C1 outputs (the scales of the patches at least), and per patch:
+	its scale, its position as fractions in [0, 1) of the range of valid 
+	positions of that scale (n x 2), and the permutation of its weights 
+	whose first nbkeptweights are kept (n x RF*RF*NBORIENT)
+	Output: n x RF x RF x NBORIENT array of prototypes
+	'''
+	RFsize = opt.C1RFSIZE
+	offsets = np.arange(RFsize)
+	prots = None
+	for scale in np.unique(scales):
+		Cchoice = output[scale]
+		assert Cchoice.shape[0] - RFsize > RFsize 
+		if prots is None:
+			prots = np.empty((len(scales), RFsize, RFsize, Cchoice.shape[2]))
+		selected = np.flatnonzero(scales == scale)
+		posx = (positions[selected, 0] * (Cchoice.shape[0] - RFsize)).astype(int)
+		posy = (positions[selected, 1] * (Cchoice.shape[1] - RFsize)).astype(int)
+		prots[selected] = Cchoice[(posx[:, np.newaxis] + offsets)[:, :, np.newaxis], 
+			(posy[:, np.newaxis] + offsets)[:, np.newaxis, :]]
+	flat = prots.reshape(len(scales), -1)
+	rows = np.arange(len(scales))[:, np.newaxis]
+	keptweights = permutations[:, :nbkeptweights]
+	# Normalized by the kept weights only, then the others are set to -1
+	flat /= np.sqrt(np.sum(flat[rows, keptweights] ** 2, axis=1))[:, np.newaxis]
+	flat[rows, permutations[:, nbkeptweights:]] = -1
+	return prots
+
+def myNormCrossCorr(stack, prot, sqstack=None):
 	""" This helper function performs a 3D cross-correlation between a 3D stack
 	of 2D maps (stack) and a 3D prototype (prot). These have the same depth,
 	and we exclude the edges, so only one 2D map is produced. 
@@ -220,11 +393,14 @@ def myNormCrossCorr(stack, prot):
 	squared. We then divide the output of the cross-correlation with the square
 	root of this map. Again, this is equivalent to multiplying the prots by the
 	inputs at each point, then dividing the result by the norm of the inputs,
-	following Kouh's method.
+	following Kouh's method. The squared stack (sqstack) is the same for all
+	prototypes, so it can be computed once and passed in.
 
 	"""
 
 	assert prot.shape[2] == stack.shape[2]
+	if sqstack is None:
+		sqstack = stack ** 2
 	NBPROTS = prot.shape[2]
 	RFSIZE = prot.shape[0] # Assuming square RFs, always
 	zerothres = RFSIZE*RFSIZE * (-1)
@@ -233,7 +409,7 @@ def myNormCrossCorr(stack, prot):
 	YSIZE = stack.shape[1]
 	norm = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
 	o2 = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
-	pi = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
+	pi = 0.0
 	for k in range(NBPROTS):
 	# If all the weights in that slice of the filter are set to -1, don't bother (note
 	# that this will be the case for >90% of slices in S3):
@@ -242,41 +418,306 @@ def myNormCrossCorr(stack, prot):
 				for j in range(RFSIZE):
 					if prot[i,j,k] > 0: #> 1e-7:
 						#cpt += 1
-						norm += stack[i:i+1+XSIZE-RFSIZE, j:j+1+YSIZE-RFSIZE, k] ** 2
+						norm += sqstack[i:i+1+XSIZE-RFSIZE, j:j+1+YSIZE-RFSIZE, k]
 						pi += prot[i,j,k] ** 2
 						o2  +=  stack[i:i+1+XSIZE-RFSIZE, j:j+1+YSIZE-RFSIZE, k] * prot[i,j,k]
 	return o2 / (((np.sqrt(norm + 1e-9))*(np.sqrt(pi + 1e-9))) + opt.SIGMAS)
 
 
 
-def runS2blayer(C1outputs, prots):
+class S2bProtIndex(object):
+	"""
+	Compact index of a set of S2b prototypes, as built by extract3DPatch().
+	Only the kept weights (the others are set to -1, i.e. "ignore") are
+	recorded, in a sparse matrix (see below); the prototype number, offset 
+	(i, j) and orientation of each kept weight are recovered from its row 
+	and column when needed.
+
+	The index is built once, and lets runS2blayer() evaluate all the prototypes
+	at once for a given scale: the kept weights form a sparse NBPROTS x 
+	(RFSIZE*RFSIZE*NBORIENT) matrix, which multiplies the im2col matrix of the
+	C1 stack (one column per position of the prototype RF in the stack).
+	When enough weights are kept, the same product is cheaper as a dense
+	(BLAS) matrix multiply; see useDense().
+
+	The weights are kept in float32, with int32 column indices: see 
+	compact() for the compact format of a prototype set (with uint8 offsets
+	and orientations), which takes about a quarter of the memory of the 
+	dense prototypes. The dense matrices of the dense backend and the mask
+	of the kept weights are only built while evaluate() runs.
+	"""
+
+	def __init__(self, prots=None):
+		'''
+		Input: dense prototypes (a list of RF x RF x NBORIENT arrays, as 
+		extract3DPatch()), compact prototypes (see compact()), or an 
+		S2bProtIndex
+		'''
+		if prots is None:
+			return
+		if isinstance(prots, S2bProtIndex):
+			prots = prots.compact()
+		if isinstance(prots, dict):
+			self.setCompact(prots)
+			return
+		prots = np.asarray(prots, dtype=float)
+		kept = prots > 0
+		self.setWeights(prots.shape, np.nonzero(kept), prots[kept])
+
+	def setWeights(self, shape, positions, weights, pi=None):
+		'''
+		Input: the shape of the dense prototypes (NBPROTS x RF x RF x NBORIENT),
+		the (prototype, i, j, orientation) positions of the kept weights, 
+		their values, and optionally the squared norm of each prototype
+		'''
+		assert max(shape[1], shape[3]) <= 256
+		# Index of each kept weight in a flattened RF x RF x NBORIENT patch, 
+		# i.e. in a row of the im2col matrix
+		column = np.ravel_multi_index(tuple(np.asarray(p, dtype=np.intp) for p in positions[1:]), shape[1:])
+		matrix = scipy.sparse.csr_matrix((np.asarray(weights, dtype=np.float32), (np.asarray(positions[0]), column)), 
+			shape=(shape[0], shape[1] * shape[2] * shape[3]))
+		matrix.sort_indices()
+		self.setMatrix(shape, matrix, pi)
+
+	def setMatrix(self, shape, matrix, pi=None):
+		'''
+		Input: the shape of the dense prototypes, the NBPROTS x 
+		(RF*RF*NBORIENT) CSR matrix of their kept weights, and optionally the
+		squared norm of each prototype
+		'''
+		self.nbprots, self.rfsize, _, self.nborient = shape
+		self.matrix = matrix
+		# The norm of each prototype (over its kept weights) is a constant
+		if pi is None:
+			pi = np.bincount(self.protnum(), matrix.data.astype(float) ** 2, minlength=self.nbprots)
+		self.pi = np.asarray(pi, dtype=float)
+		self.pinorm = np.sqrt(self.pi + 1e-9)[:, np.newaxis]
+
+	def protnum(self):
+		'''
+		Output: the prototype number of each kept weight
+		'''
+		return np.repeat(np.arange(self.nbprots, dtype=np.int32), np.diff(self.matrix.indptr))
+
+	def offsets(self):
+		'''
+		Output: the offsets (i, j) and orientation of each kept weight (uint8)
+		'''
+		return [p.astype(np.uint8) for p in np.unravel_index(self.matrix.indices, (self.rfsize, self.rfsize, self.nborient))]
+
+	def mask(self):
+		'''
+		Output: the same matrix as self.matrix, with 1s for the kept weights
+		(it shares the indices of self.matrix)
+		'''
+		return scipy.sparse.csr_matrix((np.ones(self.matrix.nnz), self.matrix.indices, self.matrix.indptr), 
+			shape=self.matrix.shape)
+
+	def compact(self):
+		'''
+		Output: the compact format of the prototypes, a dict of arrays: 'shape'
+		(of the dense prototypes), 'bounds' (the kept weights of prototype n
+		are bounds[n] to bounds[n+1]-1), 'offx', 'offy', 'orient' (uint8) and
+		'weights' (float32) of the kept weights, and the 'norm' of each
+		prototype
+		'''
+		offx, offy, orient = self.offsets()
+		return {'shape': np.array([self.nbprots, self.rfsize, self.rfsize, self.nborient]),
+			'bounds': self.matrix.indptr.astype(np.int64),
+			'offx': offx, 'offy': offy, 'orient': orient,
+			'weights': self.matrix.data.astype(np.float32), 'norm': np.sqrt(self.pi)}
+
+	def setCompact(self, arrays):
+		'''
+		Input: compact prototypes, see compact()
+		'''
+		shape = tuple(int(n) for n in arrays['shape'])
+		protnum = np.repeat(np.arange(shape[0]), np.diff(arrays['bounds']))
+		self.setWeights(shape, (protnum, arrays['offx'], arrays['offy'], arrays['orient']),
+			arrays['weights'], np.asarray(arrays['norm'], dtype=float) ** 2)
+
+	def dense(self):
+		'''
+		Output: the prototypes as NBPROTS x RF x RF x NBORIENT arrays, with the
+		non-kept weights set to -1 (as extract3DPatch())
+		'''
+		prots = -np.ones((self.nbprots, self.rfsize, self.rfsize, self.nborient))
+		prots[tuple([self.protnum()] + self.offsets())] = self.matrix.data
+		return prots
+
+	def digest(self):
+		'''
+		Hash of the prototypes, and of the options that affect the S2b output
+		'''
+		h = hashlib.sha1()
+		h.update(repr((self.nbprots, self.rfsize, self.nborient, opt.SIGMAS)))
+		for arr in [self.protnum()] + self.offsets():
+			h.update(np.ascontiguousarray(arr, dtype=np.int64).tostring())
+		h.update(np.ascontiguousarray(self.matrix.data, dtype=float).tostring())
+		return h.hexdigest()
+
+	def chunk(self, start, stop):
+		'''
+		Output: the index of prototypes start to stop-1 only
+		'''
+		stop = min(stop, self.nbprots)
+		sub = S2bProtIndex()
+		sub.setMatrix((stop - start, self.rfsize, self.rfsize, self.nborient),
+			self.matrix[start:stop], self.pi[start:stop])
+		return sub
+
+	def __len__(self):
+		return self.nbprots
+
+	def useDense(self, nbpos):
+		'''
+		Cost model for the choice of backend on a map of nbpos positions. Both
+		backends are linear in nbpos, but a dense (BLAS) multiply-add costs 
+		about 1/opt.S2BDENSESPEEDUP of a sparse one per thread, and the BLAS
+		threads only pay off on maps large enough to keep them busy. 
+		'''
+		nbthreads = max(1, min(opt.BLASTHREADS, nbpos / opt.S2BPOSPERTHREAD))
+		densecost = float(self.matrix.shape[0] * self.matrix.shape[1]) / (opt.S2BDENSESPEEDUP * nbthreads)
+		return densecost < self.matrix.nnz
+
+	def evaluate(self, stack, sqstack=None, backend=None, globalmax=False):
+		'''
+		Input: x x y x NBORIENT C1 stack, and optionally the same stack squared
+		(which can then be shared with other evaluations on the same scale)
+		Output: (x-RFSIZE+1) x (y-RFSIZE+1) x NBPROTS, the same as stacking
+		myNormCrossCorr(stack, prot) for all prots. With globalmax, only the
+		max over all positions of each prototype (NBPROTS vector): each chunk
+		of rows is reduced as soon as it is computed, and the full output is
+		never stored.
+
+		backend (default: opt.S2BBACKEND) is 'sparse', 'dense', or 'auto' to
+		let useDense() choose.
+		'''
+		assert stack.shape[2] == self.nborient
+		if backend is None:
+			backend = opt.S2BBACKEND
+		if backend not in ['auto', 'sparse', 'dense']:
+			raise ValueError('Unknown S2b backend: ' + str(backend))
+		if sqstack is None:
+			sqstack = stack ** 2
+		XSIZE = stack.shape[0] - self.rfsize + 1
+		YSIZE = stack.shape[1] - self.rfsize + 1
+		if backend == 'auto':
+			backend = 'dense' if self.useDense(XSIZE * YSIZE) else 'sparse'
+		mask = self.mask()
+		if backend == 'dense':
+			densematrix = self.matrix.T.toarray().astype(float)
+			densemask = mask.T.toarray()
+		if globalmax:
+			output = np.empty(self.nbprots)
+			output.fill(-np.inf)
+		else:
+			output = np.empty((XSIZE, YSIZE, self.nbprots))
+		# The im2col matrices are built for a few rows of the output at a 
+		# time, to bound their size on large images
+		nbrows = max(1, opt.S2BCHUNKSIZE / YSIZE)
+		for start in range(0, XSIZE, nbrows):
+			rows = slice(start, start+nbrows+self.rfsize-1)
+			cols = im2col(stack[rows], self.rfsize)
+			# For normalization, the squared inputs are the same for all 
+			# prototypes; only the kept weights differ
+			sqcols = im2col(sqstack[rows], self.rfsize)
+			if backend == 'dense':
+				o2 = np.dot(cols, densematrix)
+				norm = np.dot(sqcols, densemask)
+				out = o2 / ((np.sqrt(norm + 1e-9) * self.pinorm.T) + opt.SIGMAS)
+			else:
+				o2 = self.matrix.dot(cols.T)
+				norm = mask.dot(sqcols.T)
+				out = (o2 / ((np.sqrt(norm + 1e-9) * self.pinorm) + opt.SIGMAS)).T
+			if globalmax:
+				np.maximum(output, np.max(out, axis=0), output)
+			else:
+				output[start:start+nbrows] = out.reshape((-1, YSIZE, self.nbprots))
+		return output
+
+def im2col(stack, RFSIZE):
+	'''
+	Input: x x y x depth stack
+	Output: (x-RFSIZE+1)*(y-RFSIZE+1) x (RFSIZE*RFSIZE*depth) matrix, whose
+	rows are the flattened RFSIZE x RFSIZE x depth patches of the stack
+	'''
+	s0, s1, s2 = stack.strides
+	XSIZE = stack.shape[0] - RFSIZE + 1
+	YSIZE = stack.shape[1] - RFSIZE + 1
+	windows = np.lib.stride_tricks.as_strided(stack, 
+		shape=(XSIZE, YSIZE, RFSIZE, RFSIZE, stack.shape[2]), strides=(s0, s1, s0, s1, s2))
+	return windows.reshape((XSIZE * YSIZE, -1))
+
+def runS2blayer(C1outputs, prots, backend=None):
+	'''
+	Input: C1 outputs, and the S2b prototypes (either a list of 9x9x4 
+	prototypes, or an S2bProtIndex built from them once and for all)
+	Output: list (one per scale) of n x n x NBPROTS maps
+	See S2bProtIndex.evaluate() for the backend. Scales for which C1 was not
+	computed (None) are skipped.
+	'''
 	# print 'Running S2b layer' 
+	if not isinstance(prots, S2bProtIndex):
+		prots = S2bProtIndex(prots)
 	output=[]
 	# For each scale, extract the stack of input C layers of that scale...
 	for  scaleNum, Cthisscale in enumerate(C1outputs):
+		if Cthisscale is None:
+			output.append(None)
+			continue
 		# print '------------------------------'
 		# print 'Working on scale: ', scaleNum
 	# If the C input maps are too small, as in, smaller than the S filter,
 	# then there's no point in computing the S output; we return a depth-column 
 	# of 0s instead
 	# Note that we're assuming all the prototypes to have the same siz
-		if prots[0].shape[0] >= Cthisscale.shape[0]:
+		if prots.rfsize >= min(Cthisscale.shape[:2]):
 			# print 'Cinput map too small!'
-			outputthisscale = [0] * len(prots)
-			output.append(np.dstack(outputthisscale[:]))
+			output.append(np.zeros((1, 1, len(prots))))
 			continue
 
-		outputthisscale=[]
-		for nprot, thisprot in enumerate(prots): # thisprot is 9x9x4
-			# Filter cross-correlation !
-			#print 'Cross corr step: ', nprot, prots[nprot].shape, ' Scale:', Cthisscale.shape
-			tmp = myNormCrossCorr(Cthisscale, thisprot)         
-			outputthisscale.append(tmp)
-			assert np.max(tmp) < 1
-		output.append(np.dstack(outputthisscale[:]))
+		# Filter cross-correlation, for all the prototypes at once !
+		# The squared input planes (for normalization) are computed once per scale
+		outputthisscale = prots.evaluate(Cthisscale, Cthisscale ** 2, backend)
+		assert np.max(outputthisscale) < 1
+		output.append(outputthisscale)
 	# print 'S2b layer shape: ', len(output), output[0].shape
 	return output
 
+def runC2blayer(S2boutputs):
+	'''
+	Global max of each prototype's response, over all positions and all the
+	(computed) scales.
+	Output: NBPROTS vector
+	'''
+	#compute max for a given scale
+	max_acts = [np.max(scale.reshape(scale.shape[0]*scale.shape[1],scale.shape[2]),axis=0) 
+		for scale in S2boutputs if scale is not None]
+	return np.max(np.asarray(max_acts),axis=0) #glabal maximums
+
+def runS2bC2blayers(C1outputs, prots, backend=None):
+	'''
+	Same as runC2blayer(runS2blayer(C1outputs, prots, backend)), except that
+	the S2b maps are reduced to their global max as they are computed (see 
+	S2bProtIndex.evaluate()) instead of being stored. Use it whenever only 
+	C2b is needed.
+	'''
+	if not isinstance(prots, S2bProtIndex):
+		prots = S2bProtIndex(prots)
+	max_acts = []
+	for Cthisscale in C1outputs:
+		if Cthisscale is None:
+			continue
+		# Maps too small for the prototypes give 0s, as in runS2blayer()
+		if prots.rfsize >= min(Cthisscale.shape[:2]):
+			max_acts.append(np.zeros(len(prots)))
+			continue
+		maxthisscale = prots.evaluate(Cthisscale, Cthisscale ** 2, backend, globalmax=True)
+		assert np.max(maxthisscale) < 1
+		max_acts.append(maxthisscale)
+	return np.max(np.asarray(max_acts),axis=0)
+
 # def runS3layer(S2boutputs, prots):
 # 	print 'Running S3 layer' 
 # 	# Only check 3 smallest scales, pg 9, 1st paragraph
@@ -323,8 +764,8 @@ def scale_maxes(scales, prio_map):
 	for scale in scales:
 		# scale.shape is n x n x 600
 		scale_set = [] # will end up being 600 x 1
-		sfx = int(fx * scale.shape[0]/opt.IMGSIZE[0])
-		sfy = int(fy * scale.shape[1]/opt.IMGSIZE[1])
+		sfx = int(fx * scale.shape[0]/float(prio_map.shape[0]))
+		sfy = int(fy * scale.shape[1]/float(prio_map.shape[1]))
 		for prot_idx in xrange(scale.shape[2]):
 			# scale_set.append(np.amax(scale[:,:,prot_idx]))
 			scale_set.append(scale[sfx,sfy,prot_idx]) # order of x/y?
@@ -345,22 +786,97 @@ def comparison(a, b):
 	# return spatial.distance.euclidean(a, b)
 	# return np.dot(a, b)/np.linalg.norm(a)
 
+def rankRows(a):
+	'''
+	Ranks of the values of each row of a (ties get their average rank, as 
+	in stats.spearmanr())
+	'''
+	a = np.atleast_2d(a)
+	return np.array([stats.rankdata(row) for row in a]).reshape(a.shape)
+
+class S3ProtIndex(object):
+	"""
+	Index of a set of S3 prototypes (one list of vectors per object, as built
+	by buildS3Prots()), for runS3layer().
+
+	All the vectors are stacked in a single matrix, which is rank-transformed
+	(for opt.S3CORRELATION = 'spearman'), centered and normalized once, when
+	the index is built. The correlations of a query with all the vectors are
+	then a single matrix-vector product, as the Spearman correlation is the
+	Pearson correlation of the ranks.
+	"""
+
+	def __init__(self, prots, correlation=None):
+		'''
+		Input: list per object of lists (or arrays) of S3 vectors, and the
+		correlation used, 'spearman' (as comparison()) or 'pearson' (default:
+		opt.S3CORRELATION)
+		'''
+		if correlation is None:
+			correlation = opt.S3CORRELATION
+		assert correlation in ['spearman', 'pearson']
+		self.correlation = correlation
+		lengths = [len(objprots) for objprots in prots]
+		self.nbobjects = len(lengths)
+		self.maxlength = max(lengths)
+		# Row (object) and column (vector of that object) of each vector in
+		# the output of correlate()
+		self.objnum = np.repeat(np.arange(self.nbobjects), lengths)
+		self.vecnum = np.concatenate([np.arange(l) for l in lengths])
+		vectors = np.asarray([v for objprots in prots for v in objprots], dtype=float)
+		self.vectors, self.valid = self.standardize(vectors)
+
+	def standardize(self, vectors):
+		'''
+		Output: the vectors (ranked for 'spearman'), centered and scaled to 
+		unit norm, and whether each one is valid (constant vectors have no 
+		correlation with anything, and are left at 0)
+		'''
+		vectors = np.atleast_2d(vectors)
+		if self.correlation == 'spearman':
+			vectors = rankRows(vectors)
+		vectors = vectors - np.mean(vectors, axis=1)[:, np.newaxis]
+		norms = np.sqrt(np.sum(vectors ** 2, axis=1))
+		valid = norms > 0
+		vectors[valid] /= norms[valid, np.newaxis]
+		return vectors, valid
+
+	def __len__(self):
+		return self.nbobjects
+
+	def correlate(self, query):
+		'''
+		Input: vector of NBPROTS values
+		Output: nbobjects x maxlength array of the correlations of query
+		with each vector of each object. Objects with fewer vectors are padded
+		with 0, and the correlations with constant vectors (or a constant 
+		query) are NaN, as in stats.spearmanr().
+		'''
+		query, validquery = self.standardize(query)
+		output = np.zeros((self.nbobjects, self.maxlength))
+		output[self.objnum, self.vecnum] = np.dot(self.vectors, query[0])
+		invalid = ~(self.valid & validquery[0])
+		output[self.objnum[invalid], self.vecnum[invalid]] = np.nan
+		return output
+
 def runS3layer(S2boutputs, prots, prio_map):
+	'''
+	Input: S2b outputs (the first opt.NBS3SCALES scales at least), S3 
+	prototypes (an S3ProtIndex, or the list per object of lists of vectors,
+	which is then indexed on every call), and the priority map
+	Output: nbobjects x maxlength array of the correlations of the S2b 
+	vector at the focus with every S3 vector of every object (see
+	S3ProtIndex.correlate())
+	'''
 	print 'Running S3 layer'
-	S2bsmall = S2boutputs[:3] # 3 x n x n x 600
-	final_output = [] # want to end up with 40 x 43
+	if not isinstance(prots, S3ProtIndex):
+		prots = S3ProtIndex(prots)
+	S2bsmall = S2boutputs[:opt.NBS3SCALES] # 3 x n x n x 600
 	# S2bsmall is an array 3 of numpy arrays that are n x n x 600
 	maxes = scale_maxes(S2bsmall, prio_map)
 	# import matplotlib.pyplot as plt
 	# plt.plot(np.arange(len(maxes)), maxes)
-	for prot_idx, thisprot in enumerate(prots):
-		# thisprot is 43 x 600
-		subprots = []
-		for points in thisprot:
-			subprots.append(comparison(points, maxes))
-		final_output.append(subprots) # append a 43-length array of floats
-
-	return final_output # 40 long, and each item is 43 long
+	return prots.correlate(maxes)
 
 def runC3layer(S3outputs):
 	print "Running  C3 group (global max of S3 inputs)"
@@ -413,6 +929,21 @@ def feedbackSignal(objprots, targetIndx, imgC2b): #F(o,P), Eq 4
 	# print 'Feedback after normalization: ', feedback, np.min(feedback), np.max(feedback)
 	return feedback
 
+def feedbackMatrix(objprots, targets, C2bavg=None):
+	'''
+	Feedback signals of several targets at once, as feedbackSignal()
+	Input: objprots (nbobjs x nbprots C2b vectors), list of target indices, 
+	and optionally their getC2bAverage() if already computed
+	Output: nbtargets x nbprots matrix, one feedback signal per row
+	'''
+	if C2bavg is None:
+		C2bavg = getC2bAverage(objprots)
+	feedback = np.asarray(objprots)[list(targets)] / C2bavg
+	feedback = feedback - np.min(feedback, axis=1)[:, np.newaxis]
+	feedback = feedback / np.max(feedback, axis=1)[:, np.newaxis]
+	feedback += 1.0
+	return feedback
+
 def scalePrioMap(arr):
 	'''
 	Used for graphs, visualization
@@ -440,6 +971,21 @@ def topdownModulation(S2boutputs,feedback): #LIP MAP
 		lipMap.append(lip)
 	return lipMap
 
+def topdownModulationSums(S2boutputs, feedbacks):
+	'''
+	LIP maps of several targets at once, summed over the prototypes (which is
+	all priorityMap() uses of them): the sum over prototypes of the S2b
+	outputs weighted by each feedback signal is a single matrix product.
+	Input: S2boutputs, nbtargets x nbprots feedback matrix (feedbackMatrix())
+	Output: list per scale of nbtargets x n x n summed LIP maps
+	'''
+	lipSums = []
+	for scale in xrange(len(S2boutputs)):
+		S2bsum = np.sum(S2boutputs[scale], axis = 2)
+		lip = np.dot(S2boutputs[scale], feedbacks.T) / (S2bsum + opt.STRNORMLIP)[:,:,np.newaxis]
+		lipSums.append(np.rollaxis(lip, 2))
+	return lipSums
+
 def computeFinalStride(scale):
 	RFSIZE = opt.S1RFSIZES[scale]
 	stride = int(np.round(RFSIZE/4.0))
@@ -466,91 +1012,211 @@ def corresponding_points(ox, oy, stride, size):
 	return points
 
 def priorityMap(lipMap,originalImgSize): #Eq 6 sum over scales
-	#originalImgSize is the size of the original image, e.g., 256x256
-	# use wdt, hgt
-	wdt, hgt, numProts = lipMap[0].shape
-	priorityMap = np.zeros(originalImgSize)
-	# priorityMap = np.zeros([wdt, hgt]) # v2
+	#originalImgSize is the size of the original image, e.g., 256x256 (any
+	#size and aspect ratio works)
+	lipSums = [np.sum(lip, axis=2)[np.newaxis] for lip in lipMap]
+	return priorityMaps(lipSums, originalImgSize)[0]
 
-	pointsUsed = np.zeros(originalImgSize)
+# Back-projection operators of the LIP maps onto the image, by (LIP shape, 
+# image size, scale), see projectionOperator()
+PROJECTIONS = {}
 
-	# v3
-	for scale in xrange(len(lipMap)): # iterating over images
-		lip_S = np.sum(lipMap[scale],axis=2)
-		dims = lip_S.shape
-
-		# stride = computeFinalStride(scale)
+def projectionOperator(lipshape, originalImgSize, scale):
+	'''
+	Sparse operator scattering a LIP map of the given scale onto the image, 
+	i.e. the sum over the LIP pixels (i, j) of the image points given by 
+	corresponding_points(i, j, ...). It only depends on the geometry, so it is
+	built once per (LIP shape, image size, scale).
+	Input: shape of the LIP map, size of the original image, scale index
+	Output: (image pixels x LIP pixels) csr matrix, and the number of LIP 
+	pixels projected onto each image pixel (pointsUsed of this scale)
+	'''
+	originalImgSize = tuple(int(n) for n in originalImgSize[:2])
+	key = (tuple(lipshape), tuple(originalImgSize), scale)
+	if key not in PROJECTIONS:
 		stride = int(np.round(opt.S1RFSIZES[scale]))
-		for i in xrange(dims[0]): # iterate over pixels of LIP (smaller than image.)
-			for j in xrange(dims[1]):
-				for x, y in corresponding_points(i, j, stride, 256):
-					priorityMap[x, y] += lip_S[i, j]
-					pointsUsed[x, y] += 1
+		diff = int(np.round(stride * 0.75))
+		# Image coordinates covered by each LIP row (resp. column), as in
+		# corresponding_points()
+		xs = np.arange(lipshape[0])[:, np.newaxis] * diff + np.arange(stride)
+		ys = np.arange(lipshape[1])[:, np.newaxis] * diff + np.arange(stride)
+		i, x, j, y = np.broadcast_arrays(np.arange(lipshape[0])[:, np.newaxis, np.newaxis, np.newaxis],
+			xs[:, :, np.newaxis, np.newaxis], np.arange(lipshape[1])[:, np.newaxis], ys)
+		keep = (x < originalImgSize[0]) & (y < originalImgSize[1])
+		rows = (x * originalImgSize[1] + y)[keep]
+		cols = (i * lipshape[1] + j)[keep]
+		nbpixels = originalImgSize[0] * originalImgSize[1]
+		operator = scipy.sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+			shape=(nbpixels, lipshape[0] * lipshape[1]))
+		pointsUsed = np.bincount(rows, minlength=nbpixels).astype(float)
+		PROJECTIONS[key] = (operator, pointsUsed)
+	return PROJECTIONS[key]
+
+def priorityMaps(lipSums, originalImgSize):
+	'''
+	Priority maps of several targets at once, as priorityMap()
+	Input: list per scale of nbtargets x n x n summed LIP maps (see 
+	topdownModulationSums()), size of the original image
+	Output: nbtargets x originalImgSize priority maps
+	'''
+	originalImgSize = [int(n) for n in originalImgSize[:2]]
+	nbtargets = lipSums[0].shape[0]
+	priorityMap = np.zeros((originalImgSize[0] * originalImgSize[1], nbtargets))
+	pointsUsed = np.zeros(originalImgSize[0] * originalImgSize[1])
+	for scale in xrange(len(lipSums)):
+		lip_S = lipSums[scale]
+		operator, scalePointsUsed = projectionOperator(lip_S.shape[1:], originalImgSize, scale)
+		priorityMap += operator.dot(lip_S.reshape(nbtargets, -1).T)
+		pointsUsed += scalePointsUsed
 
 	# with np.errstate(divide='ignore', invalid='ignore'):
-	priorityMap = np.divide(priorityMap, pointsUsed)
-	return priorityMap
+	priorityMap = np.divide(priorityMap, pointsUsed[:, np.newaxis])
+	return priorityMap.T.reshape([nbtargets] + list(originalImgSize))
 
-
-def buildImageProts(numProts, s1filters): 
+def multiTargetSearch(S2boutputs, objprots, targets, originalImgSize):
+	'''
+	Priority maps of a scene for several targets, from a single S2b pass: 
+	only the feedback differs from one target to the other.
+	Input: S2boutputs of the scene, objprots (C2b vectors of the objects), list
+	of target indices, size of the scene
+	Output: nbtargets x originalImgSize priority maps, in the order of targets
+	'''
+	feedbacks = feedbackMatrix(objprots, targets)
+	return priorityMaps(topdownModulationSums(S2boutputs, feedbacks), originalImgSize)
+
+# Dependency graph of the layers: for each layer, the layer it reads, and
+# which scales of it (None: the same scales as the ones being computed). Up to
+# S2b (and LIP), each scale only depends on the same scale of the layer below.
+LAYERINPUTS = {
+	'c1': ('s1', None),
+	's2b': ('c1', None),
+	'lip': ('s2b', None),
+	'priority': ('lip', range(opt.NBS1SCALES)),
+	'c2b': ('s2b', range(opt.NBS1SCALES)),
+	's3': ('s2b', range(opt.NBS3SCALES)),
+}
+
+def requiredScales(outputs):
+	'''
+	Input: the requested outputs, e.g. ['priority'], ['c2b'] or ['s3'] (any 
+	layer in LAYERINPUTS)
+	Output: dict, for each layer needed by these outputs, of the sorted list of
+	its scales that must be computed
+	'''
+	required = {}
+	def require(layer, scales):
+		required[layer] = sorted(set(required.get(layer, [])) | set(scales))
+		if layer in LAYERINPUTS:
+			inputlayer, inputscales = LAYERINPUTS[layer]
+			require(inputlayer, scales if inputscales is None else inputscales)
+	for output in outputs:
+		if output not in LAYERINPUTS:
+			raise ValueError('Unknown output: ' + str(output))
+		require(output, [])
+	return required
+
+def runHierarchy(img, s1filters, imgProts, outputs, feedback=None):
+	'''
+	Runs the model on img, computing only the scales of S1, C1 and S2b that 
+	the requested outputs need (see requiredScales()).
+	Input: outputs is a list among 'priority' (which needs the feedback 
+	signal), 'c2b' and 's3' (the S2b scales read by runS3layer())
+	Output: dict with the C1 and S2b outputs ('c1', 's2b'; skipped scales
+	are None) and the requested 'priority' map and/or 'c2b' vector
+	'''
+	required = requiredScales(outputs)
+	result = {}
+	result['c1'] = runS1C1layers(img, s1filters, scales=required['s1'])
+	result['s2b'] = runS2blayer(result['c1'], imgProts)
+	if 'priority' in outputs:
+		assert feedback is not None
+		lipmap = topdownModulation(result['s2b'], feedback)
+		result['priority'] = priorityMap(lipmap, img.shape)
+	if 'c2b' in outputs:
+		result['c2b'] = runC2blayer(result['s2b'])
+	return result
+
+
+def buildImageProts(numProts, s1filters, nbkeptweights=None, seed=None): 
+	'''
+	Draws numProts prototypes from the natural images, as extract3DPatch() 
+	on a random image for each. All the draws (image, scale, position and 
+	kept weights) are made first, from seed, so the same seed always gives
+	the same prototypes. Then each selected image is run through S1 and C1
+	once, on the scales drawn for it only, and all its patches are 
+	extracted at once.
+	Output: S2bProtIndex of the prototypes
+	'''
+	if nbkeptweights is None:
+		nbkeptweights = opt.NBKEPTWEIGHTS
+	if seed is None:
+		seed = opt.PROTSEED
 	print 'Building ', numProts, 'protoypes from natural images'
-	imgfiles = os.listdir(opt.IMAGESFORPROTS)
-	prots = []
-	for n in range(numProts):
-		selectedImg = random.choice(range(len(imgfiles)))
-		print '----------------------------------------------------'
-		
-		imgfile = imgfiles[selectedImg]
-		print 'Prot number', n, 'select image: ', selectedImg, imgfile
-		
-		if(imgfile == '._.DS_Store' or imgfile == '.DS_Store'):
-			selectedImg = random.choice(range(len(imgfiles)))
-			imgfile = imgfiles[selectedImg]
-		img = sm.imread(opt.IMAGESFORPROTS+'/'+imgfile)
-		S1outputs = runS1layer(img, s1filters)
-		C1outputs = runC1layer(S1outputs)
-		prots.append(extract3DPatch(C1outputs, nbkeptweights = opt.NBKEPTWEIGHTS))
-	return prots
+	imgfiles = sorted(f for f in os.listdir(opt.IMAGESFORPROTS) if f not in ['.DS_Store', '._.DS_Store'])
+	rng = np.random.RandomState(seed)
+	selectedImgs = rng.randint(len(imgfiles), size=numProts)
+	scales = rng.randint(opt.NBS1SCALES, size=numProts)
+	positions = rng.random_sample((numProts, 2))
+	maskseeds = rng.randint(2**31, size=numProts)
+	prots = [None] * numProts
+	for selectedImg in np.unique(selectedImgs):
+		selected = np.flatnonzero(selectedImgs == selectedImg)
+		print 'Image', imgfiles[selectedImg], ':', len(selected), 'prototypes'
+		img = sm.imread(opt.IMAGESFORPROTS+'/'+imgfiles[selectedImg])
+		C1outputs = runS1C1layers(img, s1filters, scales=list(np.unique(scales[selected])))
+		nbweights = opt.C1RFSIZE * opt.C1RFSIZE * C1outputs[scales[selected[0]]].shape[2]
+		permutations = np.array([np.random.RandomState(maskseeds[n]).permutation(nbweights) for n in selected])
+		patches = extract3DPatches(C1outputs, scales[selected], positions[selected], permutations, nbkeptweights)
+		for n, patch in zip(selected, patches):
+			prots[n] = patch
+	# Compact format (only the kept weights), see S2bProtIndex.compact()
+	return S2bProtIndex(prots)
+
+def objectFiles():
+	'''
+	Output: the number of files in opt.IMAGESFOROBJPROTS, and the list of 
+	(prototype number, file) of the object images in it
+	'''
+	imgfiles = os.listdir(opt.IMAGESFOROBJPROTS)
+	objects = []
+	for imgfile in imgfiles:
+		if(imgfile == '.DS_Store' or imgfile == '._.DS_Store' or imgfile == '._1.normal.png' ):
+			continue
+		tmp = imgfile.strip().split('.')
+		pnum = (int(tmp[0])) -1
+		objects.append((pnum, imgfile))
+	return len(imgfiles), objects
+
+def objectC2b(imgfile, s1filters, imgProts, resize=False):
+	'''
+	Output: C2b vector of one object image of opt.IMAGESFOROBJPROTS
+	'''
+	img = sm.imread(opt.IMAGESFOROBJPROTS+'/'+imgfile, mode='I') # changed IMAGESFOROBJPROTS to get 250 nat images c2b vals
+	if resize:
+		img = sm.imresize(img, (64, 64))
+	C1outputs = runS1C1layers(img, s1filters)
+	return runS2bC2blayers(C1outputs, imgProts)
 
 def buildObjProts(s1filters, imgProts, resize=False, full=False): #computing C2b
+	'''
+	Output: list of the C2b vectors of the objects, indexed by prototype
+	number (0 for the missing ones). ModelParallel1.buildObjProts() does the 
+	same over a pool of processes, with checkpoints.
+	'''
 	print 'Building object protoypes' 
-	imgfiles = os.listdir(opt.IMAGESFOROBJPROTS) #changed IMAGESFOROBJPROTS to IMAGESFORPROTS
-	print imgfiles
+	nbfiles, objects = objectFiles()
 
-	prots = [0 for i in range(len(imgfiles)-1)]
+	prots = [0 for i in range(nbfiles-1)]
 	if full:
-		prots = [0 for i in range(len(imgfiles))]
+		prots = [0 for i in range(nbfiles)]
 	print 'Prots length: ', len(prots)
-	for n in range(len(imgfiles)):
+	for n, (pnum, imgfile) in enumerate(objects):
 		print '----------------------------------------------------'
-		print 'Working on object number', n, ' ', imgfiles[n]
-		imgfile = imgfiles[n]
-		if(imgfile == '.DS_Store' or imgfile == '._.DS_Store' or imgfile == '._1.normal.png' ):
-			continue
-		tmp = imgfile.strip().split('.')
-		#added:
-		# tmp1 = tmp[0].split('_')
-		# add finish
-		# pnum = (int(tmp1[1])) -1
-		pnum = int(tmp[0]) - 1
-		print 'pnum: ', pnum		
-
-		img = sm.imread(opt.IMAGESFOROBJPROTS+'/'+imgfile, mode='I') # changed IMAGESFOROBJPROTS to get 250 nat images c2b vals
-		if resize:
-			img = sm.imresize(img, (64, 64))
-		
+		print 'Working on object number', n, ' ', imgfile, 'pnum: ', pnum
 		t = time.time()
-		S1outputs = runS1layer(img, s1filters)
-		C1outputs = runC1layer(S1outputs)
-
-		S2boutputs = runS2blayer(C1outputs, imgProts)
-		#compute max for a given scale
-		max_acts = [np.max(scale.reshape(scale.shape[0]*scale.shape[1],scale.shape[2]),axis=0) for scale in S2boutputs]
-		C2boutputs = np.max(np.asarray(max_acts),axis=0) #glabal maximums
-		#C2boutputs = runC1layer(S2boutputs)
-		prots[pnum] = C2boutputs
+		prots[pnum] = objectC2b(imgfile, s1filters, imgProts, resize)
 		timeF = (time.time()-t)
-		print "Time elapsed: ", timeF, " Estimated time of completion: ", timeF*(len(imgfiles)-(n+1))
+		print "Time elapsed: ", timeF, " Estimated time of completion: ", timeF*(len(objects)-(n+1))
 	return prots
 
 def getObjNames():
@@ -570,38 +1236,68 @@ def getObjNames():
 	return prots
 
 
-def buildS3Prots(numprots, s1filters, imgProts, resize=False):
+def sampleS3Vectors(S2boutputs, nbvectors, rng):
+	'''
+	Draws nbvectors S3 vectors at once, with the same distribution as 
+	extractS3Vector(): a random scale among the first opt.NBS3SCALES, then a
+	random position of that scale whose S2b vector has a positive sum, and
+	the vector there, normalized.
+	Input: S2b outputs (at least the first opt.NBS3SCALES scales), number of
+	vectors, np.random.RandomState
+	Output: nbvectors x NBPROTS array
+	'''
+	# Positions of each scale with a positive sum (scales without any can
+	# never be sampled)
+	valid = []
+	for S2bthisscale in S2boutputs[:opt.NBS3SCALES]:
+		S2bthisscale = S2bthisscale.reshape(-1, S2bthisscale.shape[2])
+		valid.append((S2bthisscale, np.flatnonzero(np.sum(S2bthisscale, axis=1) > 0)))
+	valid = [v for v in valid if len(v[1]) > 0]
+	assert len(valid) > 0
+	selectedScales = rng.randint(len(valid), size=nbvectors)
+	vectors = np.empty((nbvectors, S2boutputs[0].shape[2]))
+	for scale, (S2bthisscale, positions) in enumerate(valid):
+		selected = np.flatnonzero(selectedScales == scale)
+		vectors[selected] = S2bthisscale[positions[rng.randint(len(positions), size=len(selected))]]
+	return vectors / np.sqrt(np.sum(vectors ** 2, axis=1))[:, np.newaxis]
+
+def objectS3Prots(imgfile, nbvectors, s1filters, imgProts, resize=False, seed=None):
+	'''
+	S3 prototypes of one object: its S2b outputs are computed once (on the
+	scales used by S3 only), then all the vectors are drawn from them.
+	Input: image file, number of vectors, and the seed of the draws (the
+	same image file and seed always give the same vectors)
+	Output: list of nbvectors S3 vectors
+	'''
+	if seed is None:
+		seed = opt.PROTSEED
+	img = sm.imread(opt.IMAGESFOROBJPROTS+'/'+imgfile)
+	if resize:
+		img = sm.imresize(img, (64, 64))
+	C1outputs = runS1C1layers(img, s1filters, scales=requiredScales(['s3'])['s1'])
+	S2boutputs = runS2blayer(C1outputs, imgProts)
+	rng = np.random.RandomState([seed] + [ord(c) for c in imgfile])
+	return list(sampleS3Vectors(S2boutputs, nbvectors, rng))
+
+def buildS3Prots(numprots, s1filters, imgProts, resize=False, seed=None):
+	'''
+	Builds numprots S3 prototypes, as many from each object (see 
+	objectS3Prots()). ModelParallel1.buildS3Prots() does the same over a pool
+	of processes.
+	Output: list per object (indexed by prototype number) of lists of S3 
+	vectors
+	'''
 	print 'Building S3 prots'
-	imgfiles = os.listdir(opt.IMAGESFOROBJPROTS)
-	print 'Numfiles is: ', len(imgfiles), 'Using files: ', (len(imgfiles)-1) 
-	numProtsPerObj = numprots/(len(imgfiles)-1)
-	prots = [[] for i in range(len(imgfiles))]
-	for i in range (len(imgfiles)):
-		print '----------------------------------------------------'
-		imgfile = imgfiles[i]
-		print 'Working on object number', i, ' ', imgfile
-		
-		if(imgfile == '.DS_Store' or imgfile == '._.DS_Store' or imgfile == '._1.normal.png' ):
-			continue
-		tmp = imgfile.strip().split('.')
-		pnum = (int(tmp[0])) -1
-		print 'pnum: ', pnum		
-
-		img = sm.imread(opt.IMAGESFOROBJPROTS+'/'+imgfile)
-		if resize:
-			img = sm.imresize(img, (64, 64))
-		
-		for n in range(numProtsPerObj):
-			print 'Prot number', n, 'select image: ',  imgfile
-			S1outputs = runS1layer(img, s1filters)
-			C1outputs = runC1layer(S1outputs)
-			S2boutputs = runS2blayer(C1outputs, imgProts)
-			e = extractS3Vector(S2boutputs)
-			prots[pnum].append(e)
-		print 'major percent', float(i)/len(imgfiles)
+	nbfiles, objects = objectFiles()
+	print 'Numfiles is: ', nbfiles, 'Using files: ', (nbfiles-1) 
+	numProtsPerObj = numprots/(nbfiles-1)
+	prots = [[] for i in range(nbfiles)]
+	for i, (pnum, imgfile) in enumerate(objects):
+		print 'Working on object number', i, ' ', imgfile, 'pnum: ', pnum
+		prots[pnum] = objectS3Prots(imgfile, numProtsPerObj, s1filters, imgProts, resize, seed)
 	return prots
 
-def gauss_2d(focus_x, focus_y, sigma):
+def gauss_2d(focus_x, focus_y, sigma, shape=(256, 256)):
 	# inverTED vs inverSE?  inverTED may not be the same as inverSE
 	# dims = [256, 256]
 	# grid = np.empty(dims)
@@ -609,29 +1305,224 @@ def gauss_2d(focus_x, focus_y, sigma):
 	# 	for j in xrange(dims[1]):
 	# 		grid[i, j] = stats.norm.pdf(i, focus_y, sigma) * stats.norm.pdf(j, focus_x, sigma)
 	# return grid
-	grid_y, grid_x = np.mgrid[:256, :256]
+	grid_y, grid_x = np.mgrid[:int(shape[0]), :int(shape[1])]
 	return stats.norm.pdf(grid_x, focus_x, sigma) * stats.norm.pdf(grid_y, focus_y, sigma)
 	
 def focus_location(prio):
 	relative_focus = np.argmax(prio)
-	y = math.floor(relative_focus/256)
-	x = relative_focus % 256
+	y = math.floor(relative_focus/prio.shape[1])
+	x = relative_focus % prio.shape[1]
 	return (x, y)
 
+# 1D Gaussian profiles of the IOR, by (sigma, radius), see iorProfile(), and
+# radii of the IOR window, by (sigma, factor), see iorRadius()
+PROFILES = {}
+RADII = {}
+
+def iorRadius(sigma, factor):
+	'''
+	Radius of the IOR window: the first offset from the focus at which
+	1 - factor * gauss_2d() rounds to exactly 1.0 (about 8 sigmas for the 
+	default options). The inhibition leaves every pixel past it unchanged,
+	so restricting it to the window gives exactly the same map as the full 
+	inhibition, ties included.
+	'''
+	if (sigma, factor) not in RADII:
+		peak = stats.norm.pdf(0, 0, sigma)
+		radius = int(math.ceil(sigma))
+		while 1.0 - factor * (peak * stats.norm.pdf(radius, 0, sigma)) != 1.0:
+			radius += 1
+		RADII[(sigma, factor)] = radius
+	return RADII[(sigma, factor)]
+
+def iorProfile(sigma, radius):
+	'''
+	Gaussian pdf at the integer offsets -radius..radius from the focus, the 
+	separable factor of gauss_2d() around a fixation
+	'''
+	if (sigma, radius) not in PROFILES:
+		PROFILES[(sigma, radius)] = stats.norm.pdf(np.arange(-radius, radius + 1), 0, sigma)
+	return PROFILES[(sigma, radius)]
+
+def suppressFocus(prio, focus_x, focus_y, sigma=None, factor=None):
+	'''
+	In-place inhibition of return around (focus_x, focus_y): prio is multiplied
+	by 1 - factor * gauss_2d(), restricted to the window around the focus 
+	outside of which it is exactly 1 (see iorRadius()).
+	Output: the row and column slices of prio that were modified
+	'''
+	if sigma is None:
+		sigma = opt.IORSIGMA
+	if factor is None:
+		factor = opt.GAUSSFACTOR
+	radius = iorRadius(sigma, factor)
+	profile = iorProfile(sigma, radius)
+	focus_x, focus_y = int(focus_x), int(focus_y)
+	rows = slice(max(focus_y - radius, 0), min(focus_y + radius + 1, prio.shape[0]))
+	cols = slice(max(focus_x - radius, 0), min(focus_x + radius + 1, prio.shape[1]))
+	gx = profile[cols.start - focus_x + radius:cols.stop - focus_x + radius]
+	gy = profile[rows.start - focus_y + radius:rows.stop - focus_y + radius]
+	prio[rows, cols] *= 1.0 - factor * (gx[np.newaxis, :] * gy[:, np.newaxis])
+	return rows, cols
+
 def inhibitionOfReturn(prio):
 	relative_focus = np.argmax(prio)
-	img_size = opt.IMGSIZE[0]*opt.IMGSIZE[1]
-	focus_y = math.floor(relative_focus/opt.IMGSIZE[0])
-	focus_x = relative_focus % opt.IMGSIZE[0]
+	focus_y = math.floor(relative_focus/prio.shape[1])
+	focus_x = relative_focus % prio.shape[1]
 	# k = 0.2 paper used this
 	# sigma = 16.667 paper used this
-	# print 'before gauss'
-	g = (1.0 - opt.GAUSSFACTOR*gauss_2d(focus_x, focus_y, opt.IORSIGMA))
-	# print 'after gauss'
-	# print g
-	# print prio
-	# print prio * g
-	return prio * g, focus_x, focus_y
+	prio = np.array(prio, dtype=float)
+	suppressFocus(prio, focus_x, focus_y)
+	return prio, focus_x, focus_y
+
+class IORMap(object):
+	"""
+	Priority map under successive inhibitions of return, for scanning many
+	fixations of one map. The map is split into tiles of tilesize x tilesize
+	pixels whose maxima are kept up to date, so that finding the next focus
+	only scans the tile maxima and one tile, and each inhibition only updates
+	the tiles under its window.
+
+	focus() gives the same location as focus_location() (ties are resolved
+	to the first pixel in row-major order, as np.argmax does), and inhibit()
+	the same map as inhibitionOfReturn().
+	"""
+
+	def __init__(self, prio, tilesize=None, sigma=None, factor=None):
+		if tilesize is None:
+			tilesize = opt.IORTILESIZE
+		self.prio = np.array(prio, dtype=float)
+		self.tilesize = tilesize
+		self.sigma = sigma
+		self.factor = factor
+		nbrows = (self.prio.shape[0] - 1) / tilesize + 1
+		nbcols = (self.prio.shape[1] - 1) / tilesize + 1
+		self.tilemax = np.empty((nbrows, nbcols))
+		self.updateTiles(slice(0, self.prio.shape[0]), slice(0, self.prio.shape[1]))
+
+	def updateTiles(self, rows, cols):
+		'''
+		Recomputes the maxima of the tiles overlapping prio[rows, cols]
+		'''
+		t = self.tilesize
+		firstrow, lastrow = rows.start / t, (rows.stop - 1) / t + 1
+		firstcol, lastcol = cols.start / t, (cols.stop - 1) / t + 1
+		block = self.prio[firstrow*t:lastrow*t, firstcol*t:lastcol*t]
+		# Pad the block to whole tiles (only the last row or column of tiles 
+		# of the map can be incomplete)
+		padded = np.empty(((lastrow - firstrow) * t, (lastcol - firstcol) * t))
+		padded.fill(-np.inf)
+		padded[:block.shape[0], :block.shape[1]] = block
+		padded = padded.reshape(lastrow - firstrow, t, lastcol - firstcol, t)
+		self.tilemax[firstrow:lastrow, firstcol:lastcol] = padded.max(axis=3).max(axis=1)
+
+	def focus(self):
+		'''
+		Output: (x, y) location of the maximum of the map, as focus_location()
+		'''
+		t = self.tilesize
+		best = None
+		for tilerow, tilecol in np.argwhere(self.tilemax == np.max(self.tilemax)):
+			tile = self.prio[tilerow*t:(tilerow+1)*t, tilecol*t:(tilecol+1)*t]
+			y, x = divmod(np.argmax(tile), tile.shape[1])
+			y, x = tilerow*t + y, tilecol*t + x
+			if best is None or (y, x) < best:
+				best = (y, x)
+		return best[1], best[0]
+
+	def inhibit(self, focus_x, focus_y):
+		'''
+		Inhibition of return around (focus_x, focus_y), as inhibitionOfReturn()
+		'''
+		rows, cols = suppressFocus(self.prio, focus_x, focus_y, self.sigma, self.factor)
+		self.updateTiles(rows, cols)
+
+	def fixate(self):
+		'''
+		Focuses on the maximum of the map and inhibits it
+		Output: (x, y) location of the fixation
+		'''
+		focus_x, focus_y = self.focus()
+		self.inhibit(focus_x, focus_y)
+		return focus_x, focus_y
+
+def fixations(prio, maxfixations=None):
+	'''
+	Generator of the fixations on a priority map: the focus is on its maximum,
+	then inhibited (see IORMap) before the next one. The inhibition only runs
+	when the next fixation is requested, so callers can stop as soon as the
+	target is found.
+	Input: priority map, and optionally the maximum number of fixations
+	Output: yields (x, y, priority value, elapsed time since the start)
+	'''
+	start = time.time()
+	ior = IORMap(prio)
+	nbfixations = 0
+	while maxfixations is None or nbfixations < maxfixations:
+		focus_x, focus_y = ior.focus()
+		yield focus_x, focus_y, ior.prio[focus_y, focus_x], time.time() - start
+		ior.inhibit(focus_x, focus_y)
+		nbfixations += 1
+
+class SearchSession(object):
+	"""
+	Visual search of a fixed set of targets over many scenes. Everything that
+	does not depend on the scene is computed once: the S1 filter bank, the
+	S2b prototype index, the C2b average and the feedback signals of the
+	targets, and (for the scene size given, or else on the first scene of 
+	each size) the projection operators of the priority maps.
+
+	The S2b outputs come from s2bcache.getS2b() if a cache is given (see 
+	ModelCache1.S2bCache), and are computed otherwise.
+	"""
+
+	def __init__(self, s1filters, imgProts, objprots, targets, imgshape=None, s2bcache=None):
+		if not isinstance(s1filters, S1FilterBank):
+			s1filters = S1FilterBank(s1filters)
+		if not isinstance(imgProts, S2bProtIndex):
+			imgProts = S2bProtIndex(imgProts)
+		self.s1filters = s1filters
+		self.imgProts = imgProts
+		self.targets = list(targets)
+		self.C2bavg = getC2bAverage(objprots)
+		self.feedbacks = feedbackMatrix(objprots, self.targets, self.C2bavg)
+		self.s2bcache = s2bcache
+		if imgshape is not None:
+			self.prepare(imgshape)
+
+	def prepare(self, imgshape):
+		'''
+		Builds the projection operators of the priority maps for scenes of 
+		size imgshape (the LIP shapes are those of the S2b outputs, obtained by
+		running S1 and C1 on a blank scene)
+		'''
+		C1outputs = runS1C1layers(np.zeros(imgshape[:2]), self.s1filters)
+		for scale, C1thisscale in enumerate(C1outputs):
+			if self.imgProts.rfsize >= min(C1thisscale.shape[:2]):
+				lipshape = (1, 1)
+			else:
+				lipshape = (C1thisscale.shape[0] - self.imgProts.rfsize + 1, C1thisscale.shape[1] - self.imgProts.rfsize + 1)
+			projectionOperator(lipshape, imgshape, scale)
+
+	def getS2b(self, img):
+		if self.s2bcache is not None:
+			return self.s2bcache.getS2b(img)
+		return runS2blayer(runS1C1layers(img, self.s1filters), self.imgProts)
+
+	def priorityMaps(self, img):
+		'''
+		Output: nbtargets x img.shape priority maps, in the order of targets
+		'''
+		lipSums = topdownModulationSums(self.getS2b(img), self.feedbacks)
+		return priorityMaps(lipSums, img.shape)
+
+	def run(self, img, maxfixations=None):
+		'''
+		Input: scene, and optionally the maximum number of fixations
+		Output: list, in the order of targets, of the fixations() generators
+		of their priority maps
+		'''
+		return [fixations(prio, maxfixations) for prio in self.priorityMaps(img)]
 
 def prio_modulation(prio, s2boutputs):
 	#prio = (prio - np.min(prio))/np.max(prio)
@@ -650,15 +1541,14 @@ def prio_modulation(prio, s2boutputs):
 
 def crop_s2boutputs(s2boutputs, prio):
 	relative_focus = np.argmax(prio)
-	img_size = 256.0*256.0
-	fy = math.floor(relative_focus/256)
-	fx = relative_focus % 256
+	fy = math.floor(relative_focus/prio.shape[1])
+	fx = relative_focus % prio.shape[1]
 
 	cropped = []
 
 	for idx, scale in enumerate(s2boutputs):
-		sfx = int(fx * scale.shape[0]/256.0)
-		sfy = int(fy * scale.shape[1]/256.0)
+		sfx = int(fx * scale.shape[0]/float(prio.shape[1]))
+		sfy = int(fy * scale.shape[1]/float(prio.shape[0]))
 		window_radius = int(math.ceil((scale.shape[0]/3.0)/2.0)) # assuming square.
 
 		x_size, y_size = scale.shape[:2]
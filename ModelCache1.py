@@ -0,0 +1,138 @@
+import ModelOptions1 as opt
+import Model1
+import numpy as np
+import hashlib
+import errno
+import tempfile
+import shutil
+import os
+
+class S2bCache(object):
+	"""
+	Persistent, content-addressed cache of S2b pyramids on disk.
+
+	An entry is keyed by the hashes of the image, of the S1 filter bank and of
+	the S2b prototype set, so that a scene is only run through S1 -> C1 -> S2b
+	once, whatever the target or IOR parameters used later on. Each entry is a
+	directory holding one .npy file per scale, which is loaded memory-mapped
+	(read-only).
+
+	The cache is bounded to maxbytes on disk: entries are touched whenever
+	they are read, and the least recently used ones are evicted first.
+	Several processes can share the same cache directory: any of them may
+	evict an entry that another one is reading or writing.
+	"""
+
+	def __init__(self, s1filters, imgProts, cachedir=None, maxbytes=None):
+		if cachedir is None:
+			cachedir = opt.CACHEDIR
+		if maxbytes is None:
+			maxbytes = opt.CACHEMAXBYTES
+		if not isinstance(s1filters, Model1.S1FilterBank):
+			s1filters = Model1.S1FilterBank(s1filters)
+		if not isinstance(imgProts, Model1.S2bProtIndex):
+			imgProts = Model1.S2bProtIndex(imgProts)
+		self.s1filters = s1filters
+		self.imgProts = imgProts
+		self.cachedir = cachedir
+		self.maxbytes = maxbytes
+		self.modelkey = s1filters.digest() + imgProts.digest()
+		if not os.path.isdir(cachedir):
+			os.makedirs(cachedir)
+
+	def key(self, img):
+		h = hashlib.sha1(self.modelkey)
+		h.update(repr((img.shape, img.dtype.str)))
+		h.update(np.ascontiguousarray(img).tostring())
+		return h.hexdigest()
+
+	def getS2b(self, img, scales=None):
+		'''
+		Input: n x n img, and optionally the scales needed (default: all, see
+		Model1.requiredScales())
+		Output: S2b outputs as Model1.runS2blayer() (skipped scales are None),
+		as read-only memory-mapped arrays
+		'''
+		if scales is None:
+			scales = range(opt.NBS1SCALES)
+		entry = os.path.join(self.cachedir, self.key(img))
+		S2boutputs = [None] * opt.NBS1SCALES
+		missing = []
+		for scaleidx in scales:
+			try:
+				S2boutputs[scaleidx] = np.load(os.path.join(entry, 's2b_%d.npy' % scaleidx), mmap_mode='r')
+			except IOError:
+				missing.append(scaleidx)
+		if len(missing) == 0:
+			self.touch(entry)
+			return S2boutputs
+
+		C1outputs = Model1.runS1C1layers(img, self.s1filters, scales=missing)
+		computed = Model1.runS2blayer(C1outputs, self.imgProts)
+		for scaleidx in missing:
+			S2boutputs[scaleidx] = self.store(entry, 's2b_%d.npy' % scaleidx, computed[scaleidx])
+		self.touch(entry)
+		self.evict()
+		return S2boutputs
+
+	def touch(self, entry):
+		'''
+		Marks the entry as recently used (unless another process has evicted
+		it in the meantime)
+		'''
+		try:
+			os.utime(entry, None)
+		except OSError as e:
+			if e.errno != errno.ENOENT:
+				raise
+
+	def store(self, entry, filename, array, attempts=3):
+		'''
+		Writes array to filename in the entry, and returns it as read-only
+		memory-mapped. The file is written under a temporary name, then 
+		renamed, so that readers (possibly in other processes) never see 
+		partial files. If another process evicts the entry while it is being 
+		written, the entry is created again; if that keeps failing, the array 
+		is returned (read-only) without being cached.
+		'''
+		for attempt in range(attempts):
+			try:
+				if not os.path.isdir(entry):
+					try:
+						os.makedirs(entry)
+					except OSError as e: # Created by another process in the meantime
+						if e.errno != errno.EEXIST:
+							raise
+				fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=entry)
+				with os.fdopen(fd, 'wb') as f:
+					np.save(f, array)
+				os.rename(tmpname, os.path.join(entry, filename))
+				return np.load(os.path.join(entry, filename), mmap_mode='r')
+			except (OSError, IOError) as e:
+				if e.errno != errno.ENOENT:
+					raise
+		array = array.view()
+		array.flags.writeable = False
+		return array
+
+	def evict(self):
+		'''
+		Deletes the least recently used entries until the cache fits in
+		maxbytes. Files that are still memory-mapped stay readable until
+		they are closed.
+		'''
+		entries = []
+		total = 0
+		for name in os.listdir(self.cachedir):
+			entry = os.path.join(self.cachedir, name)
+			try:
+				size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+				entries.append((os.path.getmtime(entry), size, entry))
+			except OSError: # Evicted by another process in the meantime
+				continue
+			total += size
+		for mtime, size, entry in sorted(entries):
+			if total <= self.maxbytes:
+				break
+			shutil.rmtree(entry, ignore_errors=True)
+			total -= size
@@ -4,6 +4,12 @@ S1RFSIZES = range(7,30,2)
 NBS1SCALES = len(S1RFSIZES)
 C1RFSIZE = 9
 
+# 'strided' only computes the S1 samples that are kept after striding; 'fft'
+# computes full-resolution maps. S1FFTCOST is the relative cost (per pixel per
+# log2(pixels)) of the fft convolution vs. the direct strided one.
+S1MODE = 'strided'
+S1FFTCOST = 2.0
+
 
 # Additive constants in the denominator for the normalizations in the S 
 # stages.
@@ -13,12 +19,39 @@ STRNORMLIP = 5
 
 NBPROTS = 600
 NBS3PROTS = 1720
+# S3 only reads the smallest S2b scales, pg 9, 1st paragraph
+NBS3SCALES = 3
+# Correlation of S3 ('spearman' or 'pearson') between the S2b vector at the
+# focus and the S3 prototypes
+S3CORRELATION = 'spearman'
 
 NBKEPTWEIGHTS = 100
+# Maximum number of S2b output positions evaluated at once (this bounds the
+# size of the im2col matrices)
+S2BCHUNKSIZE = 4096
+# S2b backend: 'sparse', 'dense' (BLAS) or 'auto' (cost model). A dense 
+# multiply-add is about S2BDENSESPEEDUP times cheaper than a sparse one per
+# BLAS thread; set BLASTHREADS to the number of BLAS threads (e.g. 
+# OPENBLAS_NUM_THREADS). Each thread needs about S2BPOSPERTHREAD positions.
+S2BBACKEND = 'auto'
+S2BDENSESPEEDUP = 4.0
+BLASTHREADS = 1
+S2BPOSPERTHREAD = 256
+
+# Worker processes for ModelParallel1 (None: one per CPU; BLASTHREADS should
+# then be 1), and number of S2b prototypes per task
+NBWORKERS = None
+PROTCHUNKSIZE = 100
+
+# On-disk cache of S2b pyramids (ModelCache1), and its maximum size in bytes
+CACHEDIR = './s2bcache'
+CACHEMAXBYTES = 20 * 2**30
 
 IMAGESFORPROTS = './naturalimages'
 # IMAGESFOROBJPROTS = './objectimages'
 IMAGESFOROBJPROTS = './objectimages'
+# Seed of the random draws of the prototype builders
+PROTSEED = 0
 
 # GAUSSFACTOR = 150.0
 # IORSIGMA = 35
@@ -27,6 +60,10 @@ IMAGESFOROBJPROTS = './objectimages'
 IORSIGMA = 15
 # GAUSSFACTOR = 150.0
 GAUSSFACTOR = 7.5
+# Size of the tiles over which Model1.IORMap tracks the maximum of the map
+IORTILESIZE = 16
+# Size of the original experiment scenes. The attention stages (priority map,
+# IOR) use the actual size of their input, so other sizes work natively
 IMGSIZE =[256.0,256.0]
 
 # 15 and 7.5
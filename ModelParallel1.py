@@ -0,0 +1,290 @@
+import ModelOptions1 as opt
+import Model1
+import ModelStore1
+import multiprocessing
+import numpy as np
+import tempfile
+import shutil
+import time
+import os
+
+# Per-process state of the workers, set by initWorker()
+worker = {}
+
+def initWorker(s1filters, imgProts, protchunk):
+	'''
+	Pool initializer: every worker gets its own copy of the S1 filter bank and
+	of the S2b prototypes, split into chunks of protchunk prototypes.
+	'''
+	if not isinstance(s1filters, Model1.S1FilterBank):
+		s1filters = Model1.S1FilterBank(s1filters)
+	worker['s1filters'] = s1filters
+	worker['chunks'] = [imgProts.chunk(start, start + protchunk)
+		for start in range(0, len(imgProts), protchunk)]
+
+def sharedArray(workdir, name, shape=None):
+	'''
+	Shared-memory array: a memory-mapped file in workdir (which is on tmpfs
+	when possible). It is created if shape is given, and opened otherwise.
+	'''
+	filename = os.path.join(workdir, name)
+	if shape is not None:
+		return np.memmap(filename, dtype=float, mode='w+', shape=tuple(shape))
+	return np.memmap(filename, dtype=float, mode='r+')
+
+def runS1C1task(args):
+	'''
+	S1 and C1 for one scale. The C1 maps and their squares (for the S2b
+	normalization) are written to shared memory; only their shape is returned.
+	'''
+	workdir, imgshape, scaleidx = args
+	t = time.time()
+	img = sharedArray(workdir, 'img').reshape(imgshape)
+	C1thisscale = Model1.runS1C1layers(img, worker['s1filters'], scales=[scaleidx])[scaleidx]
+	sharedArray(workdir, 'c1_%d' % scaleidx, C1thisscale.shape)[:] = C1thisscale
+	sharedArray(workdir, 'c1sq_%d' % scaleidx, C1thisscale.shape)[:] = C1thisscale ** 2
+	return scaleidx, C1thisscale.shape, time.time() - t
+
+def runS2btask(args):
+	'''
+	S2b for one scale and one chunk of prototypes, written directly into the
+	shared output of that scale.
+	'''
+	workdir, scaleidx, c1shape, chunkidx, protchunk = args
+	t = time.time()
+	Cthisscale = sharedArray(workdir, 'c1_%d' % scaleidx).reshape(c1shape)
+	Csq = sharedArray(workdir, 'c1sq_%d' % scaleidx).reshape(c1shape)
+	prots = worker['chunks'][chunkidx]
+	outputthisscale = prots.evaluate(Cthisscale, Csq)
+	assert np.max(outputthisscale) < 1
+	output = sharedArray(workdir, 's2b_%d' % scaleidx)
+	output = output.reshape(outputthisscale.shape[:2] + (-1,))
+	start = chunkidx * protchunk
+	output[:, :, start:start+len(prots)] = outputthisscale
+	output.flush()
+	return scaleidx, time.time() - t
+
+class ScaleExecutor(object):
+	"""
+	Runs the S1 -> C1 -> S2b part of the model over a pool of worker
+	processes. All the scales are independent up to S2b, and so are the
+	prototypes within a scale: S1/C1 runs as one task per scale, and S2b as
+	one task per (scale, chunk of prototypes). The image, the C1 maps and the
+	S2b outputs are passed through shared memory rather than pickled.
+
+	After each run(), self.timings holds the time spent on each scale by the
+	workers (S1/C1 and S2b separately), and the total wall-clock time.
+	"""
+
+	def __init__(self, s1filters, imgProts, nbworkers=None, protchunk=None):
+		if nbworkers is None:
+			nbworkers = opt.NBWORKERS
+		if protchunk is None:
+			protchunk = opt.PROTCHUNKSIZE
+		if not isinstance(imgProts, Model1.S2bProtIndex):
+			imgProts = Model1.S2bProtIndex(imgProts)
+		self.nbprots = len(imgProts)
+		self.rfsize = imgProts.rfsize
+		self.protchunk = protchunk
+		self.nbchunks = (self.nbprots - 1) / protchunk + 1
+		self.pool = multiprocessing.Pool(nbworkers, initWorker, (s1filters, imgProts, protchunk))
+		self.timings = None
+
+	def run(self, img, scales=None, verbose=False):
+		'''
+		Input: n x n img, and optionally the scales to compute (default: all,
+		see Model1.requiredScales())
+		Output: C1outputs, S2boutputs, as Model1.runS1C1layers() and
+		Model1.runS2blayer() (skipped scales are None)
+		'''
+		if scales is None:
+			scales = range(opt.NBS1SCALES)
+		t = time.time()
+		shmdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+		workdir = tempfile.mkdtemp(prefix='s2b', dir=shmdir)
+		try:
+			sharedArray(workdir, 'img', [img.size])[:] = np.ravel(img)
+			timings = {'s1c1': [0.0] * opt.NBS1SCALES, 's2b': [0.0] * opt.NBS1SCALES}
+			C1shapes = {}
+			for scaleidx, c1shape, elapsed in self.pool.imap_unordered(runS1C1task,
+					[(workdir, img.shape, scaleidx) for scaleidx in scales]):
+				C1shapes[scaleidx] = c1shape
+				timings['s1c1'][scaleidx] = elapsed
+
+			# If the C input maps are too small, as in, smaller than the S
+			# filter, we return a depth-column of 0s instead (see runS2blayer)
+			tasks = []
+			for scaleidx in scales:
+				c1shape = C1shapes[scaleidx]
+				if self.rfsize >= min(c1shape[:2]):
+					continue
+				s2bshape = (c1shape[0] - self.rfsize + 1, c1shape[1] - self.rfsize + 1, self.nbprots)
+				sharedArray(workdir, 's2b_%d' % scaleidx, s2bshape)
+				tasks += [(workdir, scaleidx, c1shape, chunkidx, self.protchunk)
+					for chunkidx in range(self.nbchunks)]
+			for scaleidx, elapsed in self.pool.imap_unordered(runS2btask, tasks):
+				timings['s2b'][scaleidx] += elapsed
+
+			C1outputs = [None] * opt.NBS1SCALES
+			S2boutputs = [None] * opt.NBS1SCALES
+			for scaleidx in scales:
+				c1shape = C1shapes[scaleidx]
+				C1outputs[scaleidx] = np.array(sharedArray(workdir, 'c1_%d' % scaleidx).reshape(c1shape))
+				if self.rfsize >= min(c1shape[:2]):
+					S2boutputs[scaleidx] = np.zeros((1, 1, self.nbprots))
+				else:
+					s2bshape = (c1shape[0] - self.rfsize + 1, c1shape[1] - self.rfsize + 1, self.nbprots)
+					S2boutputs[scaleidx] = np.array(sharedArray(workdir, 's2b_%d' % scaleidx).reshape(s2bshape))
+		finally:
+			shutil.rmtree(workdir)
+		timings['wall'] = time.time() - t
+		self.timings = timings
+		if verbose:
+			for scaleidx in scales:
+				print 'Scale', scaleidx, 'S1/C1:', timings['s1c1'][scaleidx], 'S2b:', timings['s2b'][scaleidx]
+			print 'Wall-clock time: ', timings['wall']
+		return C1outputs, S2boutputs
+
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+def initS3Worker(s1filters, imgProts, resize, seed):
+	'''
+	Pool initializer of buildS3Prots()
+	'''
+	if not isinstance(s1filters, Model1.S1FilterBank):
+		s1filters = Model1.S1FilterBank(s1filters)
+	worker['s1filters'] = s1filters
+	worker['imgProts'] = imgProts
+	worker['resize'] = resize
+	worker['seed'] = seed
+
+def runS3task(args):
+	'''
+	S3 prototypes of one object, see Model1.objectS3Prots()
+	'''
+	pnum, imgfile, nbvectors = args
+	t = time.time()
+	vectors = Model1.objectS3Prots(imgfile, nbvectors, worker['s1filters'], worker['imgProts'],
+		worker['resize'], worker['seed'])
+	return pnum, imgfile, vectors, time.time() - t
+
+def buildS3Prots(numprots, s1filters, imgProts, resize=False, seed=None, nbworkers=None):
+	'''
+	Same as Model1.buildS3Prots(), with the objects spread over a pool of 
+	nbworkers processes (the result does not depend on nbworkers)
+	'''
+	if nbworkers is None:
+		nbworkers = opt.NBWORKERS
+	if not isinstance(imgProts, Model1.S2bProtIndex):
+		imgProts = Model1.S2bProtIndex(imgProts)
+	print 'Building S3 prots'
+	nbfiles, objects = Model1.objectFiles()
+	numProtsPerObj = numprots/(nbfiles-1)
+	prots = [[] for i in range(nbfiles)]
+	t = time.time()
+	pool = multiprocessing.Pool(nbworkers, initS3Worker, (s1filters, imgProts, resize, seed))
+	try:
+		tasks = [(pnum, imgfile, numProtsPerObj) for pnum, imgfile in objects]
+		for i, (pnum, imgfile, vectors, elapsed) in enumerate(pool.imap_unordered(runS3task, tasks)):
+			prots[pnum] = vectors
+			print 'Object', imgfile, 'done in', elapsed, '(', i + 1, '/', len(tasks), ', total', time.time() - t, ')'
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()
+	return prots
+
+def initC2bWorker(s1filters, imgProts, resize, checkpointdir):
+	'''
+	Pool initializer of buildObjProts()
+	'''
+	if not isinstance(s1filters, Model1.S1FilterBank):
+		s1filters = Model1.S1FilterBank(s1filters)
+	worker['s1filters'] = s1filters
+	worker['imgProts'] = imgProts
+	worker['resize'] = resize
+	worker['checkpointdir'] = checkpointdir
+
+def runC2btask(args):
+	'''
+	C2b vector of one object, written to its checkpoint file (atomically, so
+	that a checkpoint file is always complete)
+	'''
+	pnum, imgfile = args
+	t = time.time()
+	C2b = Model1.objectC2b(imgfile, worker['s1filters'], worker['imgProts'], worker['resize'])
+	fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=worker['checkpointdir'])
+	with os.fdopen(fd, 'wb') as f:
+		np.save(f, C2b)
+	os.rename(tmpname, os.path.join(worker['checkpointdir'], imgfile + '.npy'))
+	return pnum, imgfile, time.time() - t
+
+def buildObjProts(s1filters, imgProts, checkpointdir, resize=False, full=False, nbworkers=None):
+	'''
+	Same as Model1.buildObjProts(), with the objects spread over a pool of 
+	nbworkers processes. The C2b vector of each object is saved in 
+	checkpointdir as soon as it is computed, and the objects already there
+	are not computed again: an interrupted build resumes where it stopped.
+	The checkpoints are tied to the filters, prototypes and resize option 
+	they were computed with (a checkpointdir built with others is refused).
+	'''
+	if nbworkers is None:
+		nbworkers = opt.NBWORKERS
+	if not isinstance(s1filters, Model1.S1FilterBank):
+		s1filters = Model1.S1FilterBank(s1filters)
+	if not isinstance(imgProts, Model1.S2bProtIndex):
+		imgProts = Model1.S2bProtIndex(imgProts)
+	if not os.path.isdir(checkpointdir):
+		os.makedirs(checkpointdir)
+	key = s1filters.digest() + imgProts.digest() + repr(bool(resize))
+	keyfile = os.path.join(checkpointdir, 'key')
+	if os.path.isfile(keyfile):
+		with open(keyfile, 'rb') as f:
+			if f.read() != key:
+				raise ValueError(checkpointdir + ' holds checkpoints of other filters, prototypes or resize option')
+	else:
+		with open(keyfile, 'wb') as f:
+			f.write(key)
+
+	print 'Building object protoypes'
+	nbfiles, objects = Model1.objectFiles()
+	prots = [0 for i in range(nbfiles if full else nbfiles-1)]
+	tasks = []
+	for pnum, imgfile in objects:
+		checkpoint = os.path.join(checkpointdir, imgfile + '.npy')
+		if os.path.isfile(checkpoint):
+			prots[pnum] = np.load(checkpoint)
+		else:
+			tasks.append((pnum, imgfile))
+	print len(objects) - len(tasks), 'objects already computed,', len(tasks), 'to go'
+	if len(tasks) > 0:
+		t = time.time()
+		pool = multiprocessing.Pool(nbworkers, initC2bWorker, (s1filters, imgProts, resize, checkpointdir))
+		try:
+			for i, (pnum, imgfile, elapsed) in enumerate(pool.imap_unordered(runC2btask, tasks)):
+				prots[pnum] = np.load(os.path.join(checkpointdir, imgfile + '.npy'))
+				total = time.time() - t
+				print 'Object', imgfile, 'done in', elapsed, '(', i + 1, '/', len(tasks), ', ETA', total / (i + 1) * (len(tasks) - i - 1), ')'
+			pool.close()
+		finally:
+			pool.terminate()
+			pool.join()
+	return prots
+
+def buildObjProtsStore(filename, s1filters, imgProts, resize=False, full=False, nbworkers=None, **metadata):
+	'''
+	Builds the C2b vectors of the objects with buildObjProts(), checkpointing
+	them in filename + '.checkpoint', and writes them to the prototype store 
+	filename (see ModelStore1). The checkpoints are deleted once the store is
+	written.
+	'''
+	checkpointdir = filename + '.checkpoint'
+	prots = buildObjProts(s1filters, imgProts, checkpointdir, resize, full, nbworkers)
+	metadata.setdefault('resize', [64, 64] if resize else None)
+	metadata.setdefault('sources', sorted(imgfile for pnum, imgfile in Model1.objectFiles()[1]))
+	metadata.setdefault('imgprots', Model1.S2bProtIndex(imgProts).digest())
+	ModelStore1.saveProts(filename, 'c2b', prots, **metadata)
+	shutil.rmtree(checkpointdir)
+	return prots
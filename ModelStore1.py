@@ -0,0 +1,215 @@
+import ModelOptions1 as opt
+import Model1
+import numpy as np
+import cPickle
+import json
+import time
+import sys
+import os
+
+# Prototype store file format: MAGIC, the length of the JSON header on 8
+# bytes (little-endian), the JSON header, then the arrays, each one
+# contiguous and aligned on ALIGN bytes. The header records the version of
+# the format, the kind of prototypes ('s2b', 'c2b' or 's3'), the dtype,
+# shape and offset of every array, and the metadata of the prototype set.
+# Version 1 stored the S2b prototypes dense; version 2 stores them in the
+# compact format of Model1.S2bProtIndex.compact().
+MAGIC = 'PROTSTORE\n'
+VERSION = 2
+ALIGN = 64
+
+class PrototypeStore(object):
+	"""
+	Read-only prototype store. The arrays are memory-mapped: opening a store
+	reads the header only, and all the processes using the same store share
+	its pages.
+
+	store['name'] is an array of the store, store.metadata the provenance of
+	the prototypes (filter bank, NBKEPTWEIGHTS, resize, source images...) and
+	store.prototypes() the prototype set in the same form as the legacy
+	cPickle files (see loadPrototypes()).
+	"""
+
+	def __init__(self, filename):
+		with open(filename, 'rb') as f:
+			if f.read(len(MAGIC)) != MAGIC:
+				raise ValueError(filename + ' is not a prototype store')
+			headersize = int(np.fromstring(f.read(8), dtype='<u8')[0])
+			header = json.loads(f.read(headersize))
+		if header['version'] > VERSION:
+			raise ValueError('Prototype store version ' + str(header['version']) + ' is not supported')
+		self.filename = filename
+		self.version = header['version']
+		self.kind = header['kind']
+		self.metadata = header['metadata']
+		self.layout = header['arrays']
+		self.arrays = {}
+
+	def __getitem__(self, name):
+		if name not in self.arrays:
+			dtype, shape, offset = self.layout[name]['dtype'], tuple(self.layout[name]['shape']), self.layout[name]['offset']
+			if np.prod(shape) == 0: # Empty files cannot be memory-mapped
+				self.arrays[name] = np.zeros(shape, dtype=dtype)
+			else:
+				self.arrays[name] = np.memmap(self.filename, dtype=dtype, mode='r', offset=offset, shape=shape)
+		return self.arrays[name]
+
+	def __contains__(self, name):
+		return name in self.layout
+
+	def prototypes(self):
+		'''
+		Output: the prototypes as in the legacy files, except for 's2b': a 
+		Model1.S2bProtIndex (or, for version 1 stores, a NBPROTS x RF x RF x
+		NBORIENT array). For 'c2b', a list of C2b vectors, with 0 for
+		the missing ones. For 's3', a list per object of (nbvectors x NBPROTS)
+		arrays. The vectors are views of the memory-mapped arrays.
+		'''
+		if self.kind == 's2b':
+			if 'prots' in self:
+				return self['prots']
+			return Model1.S2bProtIndex(dict((name, self[name]) for name in self.layout))
+		if self.kind == 'c2b':
+			return [vector if valid else 0 for vector, valid in zip(self['vectors'], self['valid'])]
+		if self.kind == 's3':
+			bounds = self['bounds']
+			return [self['vectors'][bounds[i]:bounds[i+1]] for i in range(len(bounds) - 1)]
+		raise ValueError('Unknown kind of prototypes: ' + str(self.kind))
+
+def saveStore(filename, kind, arrays, **metadata):
+	'''
+	Writes a prototype store (atomically: readers never see a partial file)
+	Input: kind of prototypes, dict of the arrays, and the metadata to record
+	(any JSON-serializable values)
+	'''
+	layout = {}
+	offset = 0
+	for name in sorted(arrays):
+		arr = np.ascontiguousarray(arrays[name])
+		arrays[name] = arr
+		layout[name] = {'dtype': arr.dtype.str, 'shape': list(arr.shape)}
+		layout[name]['offset'] = offset
+		offset += -(-arr.nbytes // ALIGN) * ALIGN
+	header = {'version': VERSION, 'kind': kind, 'arrays': layout, 'metadata': metadata}
+	# The offsets are relative to the end of the header until its size is
+	# known: the data starts at the first aligned position after it
+	start = len(MAGIC) + 8 + len(json.dumps(header)) + 20 * len(layout)
+	start = -(-start // ALIGN) * ALIGN
+	for name in layout:
+		layout[name]['offset'] += start
+	headerbytes = json.dumps(header)
+	assert len(MAGIC) + 8 + len(headerbytes) <= start
+	with open(filename + '.tmp', 'wb') as f:
+		f.write(MAGIC)
+		f.write(np.array([len(headerbytes)], dtype='<u8').tostring())
+		f.write(headerbytes)
+		for name in sorted(layout):
+			f.seek(layout[name]['offset'])
+			f.write(arrays[name].tostring())
+		f.truncate(start + offset)
+	os.rename(filename + '.tmp', filename)
+
+def isStore(filename):
+	with open(filename, 'rb') as f:
+		return f.read(len(MAGIC)) == MAGIC
+
+def loadPrototypes(filename):
+	'''
+	Loads a prototype set, from a prototype store (see 
+	PrototypeStore.prototypes()) or from a legacy cPickle file
+	'''
+	if isStore(filename):
+		return PrototypeStore(filename).prototypes()
+	with open(filename, 'rb') as f:
+		return cPickle.load(f)
+
+def packS2bProts(prots):
+	'''
+	Input: S2b prototypes (a list of RF x RF x NBORIENT arrays as 
+	extract3DPatch(), or a Model1.S2bProtIndex)
+	Output: the arrays of a 's2b' store (the compact prototypes)
+	'''
+	return Model1.S2bProtIndex(prots).compact()
+
+def packC2b(vectors):
+	'''
+	Input: list of C2b vectors, where missing ones (e.g. the .DS_Store slot
+	left by buildObjProts()) are 0
+	Output: the arrays of a 'c2b' store
+	'''
+	valid = np.array([isinstance(v, np.ndarray) for v in vectors])
+	nbprots = [len(v) for v, ok in zip(vectors, valid) if ok][0]
+	packed = np.zeros((len(vectors), nbprots))
+	for i, v in enumerate(vectors):
+		if valid[i]:
+			packed[i] = v
+	return {'vectors': packed, 'valid': valid}
+
+def packS3Prots(prots):
+	'''
+	Input: list per object of lists of S3 vectors (as buildS3Prots())
+	Output: the arrays of an 's3' store: all the vectors in a single array,
+	and the bounds of the vectors of each object in it
+	'''
+	lengths = [len(objprots) for objprots in prots]
+	vectors = [v for objprots in prots for v in objprots]
+	nbprots = len(vectors[0]) if len(vectors) > 0 else 0
+	return {'vectors': np.asarray(vectors, dtype=float).reshape(len(vectors), nbprots),
+		'bounds': np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)}
+
+PACKERS = {'s2b': packS2bProts, 'c2b': packC2b, 's3': packS3Prots}
+
+def filterMetadata():
+	'''
+	Output: description of the S1 filter bank of the current options
+	'''
+	return {'digest': Model1.buildS1filters().digest(), 'S1RFSIZES': list(opt.S1RFSIZES)}
+
+def saveProts(filename, kind, prots, **metadata):
+	'''
+	Writes a prototype set (in the legacy form) to a prototype store, with
+	the current filter bank and date in its metadata
+	'''
+	if 'filters' not in metadata:
+		metadata['filters'] = filterMetadata()
+	metadata.setdefault('created', time.strftime('%Y-%m-%d %H:%M:%S'))
+	saveStore(filename, kind, PACKERS[kind](prots), **metadata)
+
+def keptWeights(prots):
+	'''
+	Input: S2b prototypes (a list of RF x RF x NBORIENT arrays, where the
+	weights that are not kept are -1)
+	Output: their number of kept weights, or the list of the distinct 
+	numbers if they differ
+	'''
+	prots = np.asarray(prots)
+	counts = np.unique(np.sum((prots != -1).reshape(len(prots), -1), axis=1))
+	return int(counts[0]) if len(counts) == 1 else [int(n) for n in counts]
+
+def convert(kind, datfile, storefile, **metadata):
+	'''
+	Converts a legacy cPickle prototype file to a prototype store (storefile
+	may be datfile itself). Legacy files do not record the options they 
+	were built with: the number of kept weights of S2b prototypes is read 
+	from the prototypes, and the filter bank is recorded as unknown (None) 
+	unless given.
+	'''
+	with open(datfile, 'rb') as f:
+		prots = cPickle.load(f)
+	metadata.setdefault('convertedfrom', os.path.basename(datfile))
+	metadata.setdefault('filters', None)
+	if kind == 's2b':
+		metadata.setdefault('nbkeptweights', keptWeights(prots))
+	saveProts(storefile, kind, prots, **metadata)
+
+if __name__ == '__main__':
+	# python ModelStore1.py <s2b|c2b|s3> file.dat [store] [key=value ...]
+	args = [a for a in sys.argv[1:] if '=' not in a]
+	metadata = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)
+	if len(args) < 2 or args[0] not in PACKERS:
+		print 'Usage: python ModelStore1.py <s2b|c2b|s3> file.dat [store] [key=value ...]'
+		sys.exit(1)
+	kind, datfile = args[0], args[1]
+	storefile = args[2] if len(args) > 2 else datfile
+	convert(kind, datfile, storefile, **metadata)
+	print 'Converted', datfile, 'to', storefile
@@ -1,4 +1,5 @@
 import ModelOptions1 as opt
+import Model1
 import cPickle
 import random
 import pdb
@@ -171,113 +172,19 @@ def extractS3Vector(output):
 
 
 def extract3DPatch(output, nbkeptweights):
-	'''
-	Input: An 3D array 12 (scales) 4(orientations) 2D maps from C1 layer 
-	Output: 4 9x9 stack from a random scale where 100 randomly selected values from this patch were kept 
-	unmodified and everything else was set to zero 
-	'''
-	
-	RFsize = opt.C1RFSIZE
-	selectedScale = random.choice(range(len(output)))
-	print 'Selected scale: ', selectedScale
-	Cchoice = 	output[selectedScale]
-	print 'Cchoice shape: ', Cchoice.shape
-	print 'Shape of X: ', Cchoice.shape[0], ' shape of Y: ', Cchoice.shape[1], 'and RFsize: ', RFsize
-	assert Cchoice.shape[0] - RFsize > RFsize 
-	shapeX = Cchoice.shape[0] - RFsize
-	shapeY = Cchoice.shape[1] - RFsize
-
-
-	posx = random.randrange(shapeX)
-	posy = random.randrange(shapeY)
-	prot = Cchoice[posx:posx+RFsize,posy:posy+RFsize,:]
-	#print 'Size of prot:', prot.size
-	permutedweights = np.random.permutation(prot.size)
-	#print 'permuteed weights: ', permutedweights
-	keptweights = permutedweights[:nbkeptweights]
-	zeroedweights = permutedweights[nbkeptweights:]
-
-	# Here, for normalization, we just need to compute the norm of
-	# a single patch, so we don't need to go through the
-	# uniform_filter of the squared input thing...
-	# Of course only use kept weights in the normalization
-	prot = prot / np.linalg.norm(prot.flat[keptweights])
-	# Set non-kept weights to -1 - *after* normalizing...
-	prot.flat[zeroedweights] = -1
-	return prot
+	# Same patch as Model1 (see Model1.extract3DPatch(), and 
+	# Model1.extract3DPatches() for many at once)
+	return Model1.extract3DPatch(output, nbkeptweights)
 
 def myNormCrossCorr(stack, prot):
-	""" This helper function performs a 3D cross-correlation between a 3D stack
-	of 2D maps (stack) and a 3D prototype (prot). These have the same depth,
-	and we exclude the edges, so only one 2D map is produced. 
-
-	This is done by summing shifted versions of the input stack, multiplied by
-	the appropriated value of the prototype.
-	
-	This method is much faster than anything else (including FFT convolution)
-	due to the fact that the majority of weights are set to -1 (i.e. "ignore"),
-	following Serre (see extractCpatch()).
-	
-	For normalization, we also sum shifted versions of the input stack,
-	squared. We then divide the output of the cross-correlation with the square
-	root of this map. Again, this is equivalent to multiplying the prots by the
-	inputs at each point, then dividing the result by the norm of the inputs,
-	following Kouh's method.
-
-	"""
-
-	assert prot.shape[2] == stack.shape[2]
-	NBPROTS = prot.shape[2]
-	RFSIZE = prot.shape[0] # Assuming square RFs, always
-	zerothres = RFSIZE*RFSIZE * (-1)
-	#cpt = 0 # For debugging
-	XSIZE = stack.shape[0]
-	YSIZE = stack.shape[1]
-	norm = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
-	o2 = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
-	pi = np.zeros((XSIZE-RFSIZE+1, YSIZE-RFSIZE+1))
-	for k in range(NBPROTS):
-	# If all the weights in that slice of the filter are set to -1, don't bother (note
-	# that this will be the case for >90% of slices in S3):
-		if np.sum(prot[:,:,k]) > zerothres:
-			for i in range(RFSIZE):
-				for j in range(RFSIZE):
-					if prot[i,j,k] > 0: #> 1e-7:
-						#cpt += 1
-						norm += stack[i:i+1+XSIZE-RFSIZE, j:j+1+YSIZE-RFSIZE, k] ** 2
-						pi += prot[i,j,k] ** 2
-						o2  +=  stack[i:i+1+XSIZE-RFSIZE, j:j+1+YSIZE-RFSIZE, k] * prot[i,j,k]
-	return o2 / (((np.sqrt(norm + 1e-9))*(np.sqrt(pi + 1e-9))) + opt.SIGMAS)
-
-
+	# Same normalized cross-correlation as Model1, through the compact 
+	# prototype index (see Model1.S2bProtIndex.evaluate())
+	return Model1.S2bProtIndex([prot]).evaluate(stack)[:, :, 0]
 
 def runS2blayer(C1outputs, prots):
-	# print 'Running S2b layer' 
-	output=[]
-	# For each scale, extract the stack of input C layers of that scale...
-	for  scaleNum, Cthisscale in enumerate(C1outputs):
-		# print '------------------------------'
-		# print 'Working on scale: ', scaleNum
-	# If the C input maps are too small, as in, smaller than the S filter,
-	# then there's no point in computing the S output; we return a depth-column 
-	# of 0s instead
-	# Note that we're assuming all the prototypes to have the same siz
-		if prots[0].shape[0] >= Cthisscale.shape[0]:
-			# print 'Cinput map too small!'
-			outputthisscale = [0] * len(prots)
-			output.append(np.dstack(outputthisscale[:]))
-			continue
-
-		outputthisscale=[]
-		for nprot, thisprot in enumerate(prots): # thisprot is 9x9x4
-			# Filter cross-correlation !
-			#print 'Cross corr step: ', nprot, prots[nprot].shape, ' Scale:', Cthisscale.shape
-			tmp = myNormCrossCorr(Cthisscale, thisprot)         
-			outputthisscale.append(tmp)
-			assert np.max(tmp) < 1
-		output.append(np.dstack(outputthisscale[:]))
-	# print 'S2b layer shape: ', len(output), output[0].shape
-	return output
+	# Same S2b layer as Model1 (the prototypes can be dense or compact, see
+	# Model1.S2bProtIndex)
+	return Model1.runS2blayer(C1outputs, prots)
 
 
 def scale_maxes(scales, prio_map):
@@ -315,33 +222,65 @@ def comparison(a, b):
 
 
 
+def zscoreRows(vectors):
+	'''
+	Output: the rows of vectors centered and scaled to unit norm, so that the
+	dot product of two of them is their correlation, as comparison()
+	'''
+	vectors = vectors - np.mean(vectors, axis=1)[:, np.newaxis]
+	return vectors / np.sqrt(np.sum(vectors ** 2, axis=1))[:, np.newaxis]
+
+def meanS3Prots(prots):
+	'''
+	Input: list per object of lists of S3 vectors
+	Output: nbobjects x NBPROTS array of the mean of the z-scored vectors of
+	each object (0 for objects without vectors). As the correlation is 
+	linear in each z-scored vector, the mean correlation of a vector with 
+	the vectors of an object is its correlation with this mean.
+	'''
+	nbprots = [len(thisprot[0]) for thisprot in prots if len(thisprot) > 0][0]
+	meanprots = np.zeros((len(prots), nbprots))
+	for prot_idx, thisprot in enumerate(prots):
+		if len(thisprot) > 0:
+			meanprots[prot_idx] = np.mean(zscoreRows(np.asarray(thisprot, dtype=float)), axis=0)
+	return meanprots
+
+def s3ScaleMap(scale, meanprots):
+	'''
+	Input: n x n x NBPROTS S2b scale, and the output of meanS3Prots()
+	Output: n x n x nbobjects map of the mean correlation of the S2b vector
+	at each location with the S3 vectors of each object. The locations are 
+	z-scored and multiplied with all the objects at once, opt.S2BCHUNKSIZE 
+	locations at a time to bound the memory used.
+	'''
+	vectors = scale.reshape(-1, scale.shape[2])
+	output = np.empty((vectors.shape[0], len(meanprots)))
+	for start in range(0, vectors.shape[0], opt.S2BCHUNKSIZE):
+		stop = start + opt.S2BCHUNKSIZE
+		output[start:stop] = np.dot(zscoreRows(vectors[start:stop]), meanprots.T)
+	return output.reshape(scale.shape[:2] + (len(meanprots),))
+
 def runS3layer(S2boutputs, prots):
+	'''
+	Input: S2b outputs (the first 2 scales at least), and the list per 
+	object of lists of S3 vectors (or the output of meanS3Prots(), to 
+	compute it only once)
+	Output: per object, the mean over locations and scales of the mean 
+	correlation of the S2b vector at each location with the object's S3 
+	vectors (see s3ScaleMap())
+	'''
 	print 'Running S3 layer'
 	
 	S2bsmall = S2boutputs[:2] # 3 x n x n x 600
+	if not (isinstance(prots, np.ndarray) and prots.ndim == 2):
+		prots = meanS3Prots(prots)
 	# S2bsmall is an array 3 of numpy arrays that are n x n x 600
 	s3scalemaps = np.empty([len(S2bsmall), len(prots)]) # 40 maps at each scale		
-	print 'Initialize empty scale map. shape is: ', s3scalemaps.shape
 	for scale_idx, scale in enumerate(S2bsmall):
-		eachscale= np.empty([scale.shape[0],scale.shape[1]]) 
-		scale = scale / np.linalg.norm(scale)
-		print '----WORKING ON SCALE: ', scale_idx, scale.shape
-		for prot_idx, thisprot in enumerate(prots):
-			# 40 prots, thisprot is 43x600
-			print 'prot id:::::::::', prot_idx
-			for i in np.arange(scale.shape[0]):
-				for j in np.arange(scale.shape[1]):
-					scaleVec = scale[i,j,:]
-					eachprot = []
-					#print 'Thisprot shape is: ', len(thisprot), len(thisprot[0])
-					for k in np.arange(len(thisprot)):
-						#print 'Scalevec size: ', len(scaleVec), ' thisprot size: ', len(thisprot[k])
-						eachprot.append(comparison(scaleVec,thisprot[k]))
-					if(len(eachprot) == 0):
-						eachscale[i,j] = 0
-					else:
-						eachscale[i,j] = np.meanf(eachprot)
-			s3scalemaps[scale_idx,prot_idx] = np.mean(eachscale) # should have length of 40 for each scale
+		# The correlations do not depend on the scaling of the S2b vectors,
+		# so the scale does not need to be normalized
+		eachscale = s3ScaleMap(scale, prots)
+		s3scalemaps[scale_idx] = np.mean(eachscale.reshape(-1, len(prots)), axis=0) # should have length of 40 for each scale
 		
 	return np.mean(s3scalemaps, axis=0) # 40 long
 
@@ -474,24 +413,9 @@ def priorityMap(lipMap,originalImgSize): #Eq 6 sum over scales
 
 
 def buildImageProts(numProts, s1filters): 
-	print 'Building ', numProts, 'protoypes from natural images'
-	imgfiles = os.listdir(opt.IMAGESFORPROTS)
-	prots = []
-	for n in range(numProts):
-		selectedImg = random.choice(range(len(imgfiles)))
-		print '----------------------------------------------------'
-		
-		imgfile = imgfiles[selectedImg]
-		print 'Prot number', n, 'select image: ', selectedImg, imgfile
-		
-		if(imgfile == '._.DS_Store' or imgfile == '.DS_Store'):
-			selectedImg = random.choice(range(len(imgfiles)))
-			imgfile = imgfiles[selectedImg]
-		img = sm.imread(opt.IMAGESFORPROTS+'/'+imgfile)
-		S1outputs = runS1layer(img, s1filters)
-		C1outputs = runC1layer(S1outputs)
-		prots.append(extract3DPatch(C1outputs, nbkeptweights = opt.NBKEPTWEIGHTS))
-	return prots
+	# Same prototypes as Model1, as a compact Model1.S2bProtIndex (see 
+	# Model1.buildImageProts())
+	return Model1.buildImageProts(numProts, s1filters)
 
 def buildObjProts(s1filters, imgProts, resize=False, full=False): #computing C2b
 	print 'Building object protoypes' 
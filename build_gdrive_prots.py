@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelParallel1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -13,18 +15,18 @@ import ModelOptions1 as opt
 
 reload(opt)
 reload(Model1)
+reload(ModelStore1)
 
 
 # Build filters
 s1filters = Model1.buildS1filters()
 print 'Loaded s1 filters'
-with open('imgprots.dat', 'rb') as pf:
-    imgprots = cPickle.load(pf)
+imgprots = Model1.S2bProtIndex(ModelStore1.loadPrototypes('imgprots.dat'))
 
-objprots = Model1.buildObjProts(s1filters, imgprots, resize=True, full=True)
+# Checkpointed: if interrupted, running this again resumes the build
+objprots = ModelParallel1.buildObjProtsStore('gdrivesets/prots/objprots_smallerscales.dat',
+    s1filters, imgprots, resize=True, full=True)
 print objprots
-with open('gdrivesets/prots/objprots_smallerscales.dat', 'wb') as f:
-    cPickle.dump(objprots, f, protocol=-1)
 
 # s3prots = Model1.buildS3Prots(2 * 43, s1filters, imgprots)
 # with open('gdrivesets/prots/s3prots_25.dat', 'wb') as f:
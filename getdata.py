@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelCache1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -13,6 +15,8 @@ import ModelOptions1 as opt
 
 reload(opt)
 reload(Model1) 
+reload(ModelStore1)
+reload(ModelCache1)
 
 beginning = 372
 change = 10
@@ -21,21 +25,19 @@ change = 10
 # Build filters
 s1filters = Model1.buildS1filters()
 print 'Loaded s1 filters'
-protsfile = open('imgprots.dat', 'rb')
-imgprots = cPickle.load(protsfile)#[beginning:beginning+change]
+imgprots = ModelStore1.loadPrototypes('imgprots.dat')#[beginning:beginning+change]
+imgprots = Model1.S2bProtIndex(imgprots)
+s2bcache = ModelCache1.S2bCache(s1filters, imgprots)
 print 'Loading objprots filters'
-protsfile = open('objprotsCorrect.dat', 'rb')
-objprots = cPickle.load(protsfile)
+objprots = ModelStore1.loadPrototypes('objprotsCorrect.dat')
 for idx, _ in enumerate(objprots):
     objprots[idx] = objprots[idx]#[beginning:beginning+change]
 # objprots = objprots[0:-1] # NOTE THIS IS HACK because objprots was generated from a folder with 41 instead of 40 images. Getting rid of the last img.
 print 'Objprots shape:', len(objprots), objprots[0].shape
-protsfile = open('naturalImgC2b.dat', 'rb')
-imgC2b = cPickle.load(protsfile)
+imgC2b = ModelStore1.loadPrototypes('naturalImgC2b.dat')
 print 'imgC2b: ', len(imgC2b)
 imgC2b = imgC2b[0:-1]
-with open('S3prots.dat', 'rb') as f:
-    s3prots = cPickle.load(f)[:-1]
+s3prots = ModelStore1.loadPrototypes('S3prots.dat')[:-1]
 #num_objs x num_scales x n x n x prototypes
 
 # Model1.buildS3Prots(1720,s1filters,imgprots)
@@ -144,8 +146,8 @@ target_test_set = [
 
 fin = []
 
-def check_bounds(loc, x, y):
-    wh = 256/3.0
+def check_bounds(loc, x, y, size):
+    wh = size/3.0
     bounds = [
         loc[0] * wh,
         (loc[0]+1) * wh,
@@ -156,22 +158,21 @@ def check_bounds(loc, x, y):
 
 for stimnum, targetIndex, location in target_test_set:
     img = scipy.misc.imread('stimuli/1.array{}.ot.png'.format(stimnum))
-    S1outputs = Model1.runS1layer(img, s1filters)
-    C1outputs = Model1.runC1layer(S1outputs)
-    S2boutputs = Model1.runS2blayer(C1outputs, imgprots)
+    S2boutputs = s2bcache.getS2b(img)
     feedback = Model1.feedbackSignal(objprots, targetIndex, imgC2b)
     lipmap = Model1.topdownModulation(S2boutputs,feedback)
 
-    priorityMap = Model1.priorityMap(lipmap,[256,256])
+    priorityMap = Model1.priorityMap(lipmap,img.shape)
 
     i = 0
     found = False
-    while i < 5 and not found:
+    for fx, fy, _, elapsed in Model1.fixations(priorityMap, 5):
         print i, 'start'
-        priorityMap, fx, fy = Model1.inhibitionOfReturn(priorityMap)
-        found = check_bounds(location, fx, fy)
-        print 'end'
+        found = check_bounds(location, fx, fy, img.shape[1])
+        print 'end', elapsed
         i += 1
+        if found:
+            break
 
     fin.append((i, found))
 
@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelCache1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -15,16 +17,17 @@ import os
 
 reload(opt)
 reload(Model1)
+reload(ModelStore1)
+reload(ModelCache1)
 
 
 # Build filters
 s1filters = Model1.buildS1filters()
-protsfile = open('imgprots.dat', 'rb')
-imgprots = cPickle.load(protsfile)
-with open('gdrivesets/prots/objprots_smallerscales.dat', 'rb') as f:
-    objprots = cPickle.load(f)
-with open('gdrivesets/prots/objprots_smallerscales.dat', 'rb') as f: # correct file?
-    imgC2b = cPickle.load(f)
+imgprots = ModelStore1.loadPrototypes('imgprots.dat')
+imgprots = Model1.S2bProtIndex(imgprots)
+s2bcache = ModelCache1.S2bCache(s1filters, imgprots)
+objprots = ModelStore1.loadPrototypes('gdrivesets/prots/objprots_smallerscales.dat')
+imgC2b = ModelStore1.loadPrototypes('gdrivesets/prots/objprots_smallerscales.dat') # correct file?
 
 # img = scipy.misc.imread('gdrivesets/scenes/5and2/setsize{}_{}.png'.format(12, 36), mode='I')
 datatype = 'blackandwhite'
@@ -38,7 +41,7 @@ img = scipy.misc.imread(filename, mode='I')
 S1outputs = Model1.runS1layer(img, s1filters)
 C1outputs = Model1.runC1layer(S1outputs)
 print 'before s2b'
-S2boutputs = Model1.runS2blayer(C1outputs, imgprots)
+S2boutputs = s2bcache.getS2b(img)
 print 'after s2b'
 targetIndex = 0
 feedback = Model1.feedbackSignal(objprots, targetIndex, imgC2b)
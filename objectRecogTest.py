@@ -2,6 +2,7 @@ import traceback
 import sys
 import cPickle
 import ObjectRecogPathTest as Model1
+import ModelStore1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -13,6 +14,7 @@ import ModelOptions1 as opt
 
 reload(opt)
 reload(Model1) 
+reload(ModelStore1)
 
 beginning = 372
 change = 10
@@ -21,22 +23,17 @@ change = 10
 # Build filters
 s1filters = Model1.buildS1filters()
 print 'Loaded s1 filters'
-protsfile = open('imgprots.dat', 'rb')
-imgprots = cPickle.load(protsfile)#[beginning:beginning+change]
+imgprots = ModelStore1.loadPrototypes('imgprots.dat')#[beginning:beginning+change]
 print 'Loading objprots filters'
-protsfile = open('objprots_44x44.dat', 'rb')
-objprots = cPickle.load(protsfile)
+objprots = ModelStore1.loadPrototypes('objprots_44x44.dat')
 for idx, _ in enumerate(objprots):
     objprots[idx] = objprots[idx]#[beginning:beginning+change]
 # objprots = objprots[0:-1] # NOTE THIS IS HACK because objprots was generated from a folder with 41 instead of 40 images. Getting rid of the last img.
-protsfile = open('naturalImgC2b.dat', 'rb')
-imgC2b = cPickle.load(protsfile)
+imgC2b = ModelStore1.loadPrototypes('naturalImgC2b.dat')
 print 'imgC2b: ', len(imgC2b)
 imgC2b = imgC2b[0:-1]
-#with open('S3prots.dat', 'rb') as f:
-with open('s3prots_44x44.dat', 'rb') as f:
-    #s3prots = cPickle.load(f)[:-1]
-    s3prots = cPickle.load(f)[:-1]
+#s3prots = ModelStore1.loadPrototypes('S3prots.dat')[:-1]
+s3prots = Model1.meanS3Prots(ModelStore1.loadPrototypes('s3prots_44x44.dat')[:-1])
 print 'S3prots length: ', len(s3prots)
 #num_objs x num_scales x n x n x prototypes
 #prots = Model1.buildS3Prots(1720,s1filters,imgprots, True)
@@ -96,7 +93,7 @@ protID = np.argmax(feedback)
 print feedback[protID], np.mean(feedback)
 print 'lipmap shape: ', len(lipmap), lipmap[0].shape
 
-priorityMap = Model1.priorityMap(lipmap, opt.IMGSIZE)
+priorityMap = Model1.priorityMap(lipmap, img.shape)
 
 # i = 0
 # found = False
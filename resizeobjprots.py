@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelParallel1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -13,6 +15,7 @@ import ModelOptions1 as opt
 
 reload(opt)
 reload(Model1) 
+reload(ModelStore1)
 
 beginning = 372
 change = 10
@@ -21,13 +24,11 @@ change = 10
 # Build filters
 s1filters = Model1.buildS1filters()
 print 'Loaded s1 filters'
-with open('imgprots.dat', 'rb') as f:
-    imgprots = cPickle.load(f)
+imgprots = Model1.S2bProtIndex(ModelStore1.loadPrototypes('imgprots.dat'))
 
 # objprots = Model1.buildObjProts(s1filters, imgprots, resize=True)
 # with open('resizedobjprots.dat', 'wb') as f:
 #     cPickle.dump(objprots, f, protocol=-1)
 
-s3prots = Model1.buildS3Prots(1720, s1filters, imgprots, resize=True)
-with open('resizeds3prots.dat', 'wb') as f:
-    cPickle.dump(s3prots, f, protocol=-1)
\ No newline at end of file
+s3prots = ModelParallel1.buildS3Prots(1720, s1filters, imgprots, resize=True)
+ModelStore1.saveProts('resizeds3prots.dat', 's3', s3prots, resize=[64, 64])
\ No newline at end of file
@@ -0,0 +1,175 @@
+import multiprocessing
+import Model1
+import ModelStore1
+import ModelCache1
+import scipy.misc
+import time
+import sys
+import ModelOptions1 as opt
+import json
+import os
+
+# Parallel, resumable version of runCustomSets.py:
+#   python runBatchSets.py <datatype> <target[,target...]> [nbworkers] [--merge]
+# Scenes are spread over a pool of worker processes, and every worker appends
+# its results to its own journal (one json line per (scene, target)) in
+# gdrivesets/fixationdata/<datatype>_journal/. There is no separate resume
+# index: on every start, all the journals are read in full, and the
+# (scene, target) pairs found in them are skipped, so an interrupted run can
+# simply be started again. With --merge, the journals are then merged into the
+# _final.txt files written by runCustomSets.py.
+
+FIXATIONDIR = 'gdrivesets/fixationdata'
+
+def check_bounds(px, py, rx, ry, box_radius):
+    bounds = [
+        rx - box_radius,
+        rx + box_radius,
+        ry - box_radius,
+        ry + box_radius
+    ]
+    return px >= bounds[0] and px <= bounds[1] and py >= bounds[2] and py <= bounds[3]
+
+def journal_dir(datatype):
+    return os.path.join(FIXATIONDIR, '{}_journal'.format(datatype))
+
+def read_journals(datatype):
+    '''
+    All the records of the journals of datatype, as dicts. A line cut short by
+    an interrupted run is ignored (its scene will be run again).
+    '''
+    records = []
+    if not os.path.isdir(journal_dir(datatype)):
+        return records
+    for journal in sorted(os.listdir(journal_dir(datatype))):
+        if not journal.endswith('.jsonl'):
+            continue
+        with open(os.path.join(journal_dir(datatype), journal), 'rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+def results_filename(datatype, targets, target):
+    # same files as runCustomSets.py
+    if len(targets) == 1:
+        return os.path.join(FIXATIONDIR, '{}_final.txt'.format(datatype))
+    return os.path.join(FIXATIONDIR, '{}_{}_final.txt'.format(datatype, target))
+
+def merge_journals(datatype, targets):
+    '''
+    Writes the journal records of each target into its _final.txt file
+    (keeping the scenes of that file that are not in the journals)
+    '''
+    records = read_journals(datatype)
+    for target in targets:
+        filename = results_filename(datatype, targets, target)
+        lines = {}
+        if os.path.isfile(filename):
+            with open(filename, 'rb') as f:
+                for line in f.read().split('\n'):
+                    if line:
+                        lines[line.split(' :: ')[0]] = line
+        for record in records:
+            if record['target'] == target:
+                lines[record['scene']] = '{} :: {} :: {}'.format(record['scene'], record['fixations'], record['found'])
+        with open(filename + '.tmp', 'wb') as f:
+            for name in sorted(lines):
+                f.write(lines[name] + '\n')
+        os.rename(filename + '.tmp', filename)
+        print 'Merged', len(lines), 'scenes into', filename
+
+# Per-process state of the workers, set by init_worker()
+worker = {}
+
+def init_worker(datatype, targets):
+    s1filters = Model1.buildS1filters()
+    imgprots = Model1.S2bProtIndex(ModelStore1.loadPrototypes('imgprots.dat'))
+    objprots = ModelStore1.loadPrototypes('gdrivesets/prots/objprots.dat')
+    s2bcache = ModelCache1.S2bCache(s1filters, imgprots)
+    worker['session'] = Model1.SearchSession(s1filters, imgprots, objprots, targets, s2bcache=s2bcache)
+    worker['datatype'] = datatype
+    # One journal per worker, so that every file has a single writer
+    journal = os.path.join(journal_dir(datatype), '{}_{}.jsonl'.format(int(time.time()), os.getpid()))
+    worker['journal'] = os.open(journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+def run_scene(args):
+    '''
+    Runs the search of one scene, and journals the result of each of the
+    given targets
+    Output: scene name, number of targets run, time spent
+    '''
+    name, position, targets = args
+    t = time.time()
+    filename = 'gdrivesets/scenes/{}/{}'.format(worker['datatype'], name)
+    fixations_allowed = int(name.split('_')[0][7:])
+    img = scipy.misc.imread(filename, mode='I')
+    box_radius = (img.shape[1]/5.0)/2.0
+    searches = worker['session'].run(img, fixations_allowed)
+    for target, search in zip(worker['session'].targets, searches):
+        if target not in targets:
+            continue
+        i = 0
+        found = False
+        path = []
+        for fx, fy, _, _ in search:
+            i += 1
+            path.append([int(fx), int(fy)])
+            found = check_bounds(fx, fy, position[0], position[1], box_radius)
+            if found:
+                break
+        record = {'scene': name, 'target': target, 'fixations': i, 'found': bool(found), 'path': path}
+        # A single write of a whole line in append mode: a record is either
+        # fully in the journal or (if interrupted) a truncated last line
+        os.write(worker['journal'], json.dumps(record) + '\n')
+    os.fsync(worker['journal'])
+    return name, len(targets), time.time() - t
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    datatype = args[0]
+    if datatype not in ['5and2', 'blackandwhite', 'conjunction']:
+        raise Exception('Bad datatype')
+    targets = [int(t) for t in args[1].split(',')]
+    nbworkers = int(args[2]) if len(args) > 2 else opt.NBWORKERS
+
+    with open('gdrivesets/scenejson/{}.json'.format(datatype), 'rb') as f:
+        dataset = json.load(f)
+    if not os.path.isdir(journal_dir(datatype)):
+        os.makedirs(journal_dir(datatype))
+
+    done = set((record['scene'], record['target']) for record in read_journals(datatype))
+    tasks = []
+    for name, position in sorted(dataset.iteritems()):
+        if not os.path.isfile('gdrivesets/scenes/{}/{}'.format(datatype, name)):
+            continue
+        torun = [target for target in targets if (name, target) not in done]
+        if len(torun) > 0:
+            tasks.append((name, position, torun))
+    total = sum(len(task[2]) for task in tasks)
+    print len(done), 'results already journaled,', total, 'to run over', len(tasks), 'scenes'
+
+    if len(tasks) > 0:
+        pool = multiprocessing.Pool(nbworkers, init_worker, (datatype, targets))
+        start = time.time()
+        completed = 0
+        try:
+            for name, nbtargets, elapsed in pool.imap_unordered(run_scene, tasks):
+                completed += nbtargets
+                rate = completed / (time.time() - start)
+                print '{} done in {:.1f}s  [{}/{}, {:.2f} results/s, ETA {}]'.format(name, elapsed,
+                    completed, total, rate, format_duration((total - completed) / rate))
+        finally:
+            # every result is journaled by then (or lost with its scene, on
+            # an interruption), so the workers can be stopped right away
+            pool.terminate()
+            pool.join()
+
+    if '--merge' in sys.argv:
+        merge_journals(datatype, targets)
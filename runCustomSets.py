@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelCache1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -15,6 +17,8 @@ import os
 
 reload(opt)
 reload(Model1)
+reload(ModelStore1)
+reload(ModelCache1)
 
 # important stuff.  other important stuff can be found in ModelOptions1
 # datatype = '5and2'
@@ -23,18 +27,19 @@ if datatype not in ['5and2', 'blackandwhite', 'conjunction']:
     raise Exception('Bad datatype')
 # datatype = 'blackandwhite'
 # datatype = 'conjunction'
-targetIndex = int(sys.argv[2])
+# one target index, or a comma-separated list of them: the S2b pass of each
+# scene is then shared by all the targets
+targets = [int(t) for t in sys.argv[2].split(',')]
 
 
 # Build filters
 s1filters = Model1.buildS1filters()
-protsfile = open('imgprots.dat', 'rb')
-imgprots = cPickle.load(protsfile)
-with open('gdrivesets/prots/objprots.dat', 'rb') as f:
-    objprots = cPickle.load(f)
+imgprots = ModelStore1.loadPrototypes('imgprots.dat')
+imgprots = Model1.S2bProtIndex(imgprots)
+s2bcache = ModelCache1.S2bCache(s1filters, imgprots)
+objprots = ModelStore1.loadPrototypes('gdrivesets/prots/objprots.dat')
 
-box_radius = (256/5.0)/2.0
-def check_bounds(px, py, rx, ry):
+def check_bounds(px, py, rx, ry, box_radius):
     bounds = [
         rx - box_radius,
         rx + box_radius,
@@ -46,39 +51,51 @@ def check_bounds(px, py, rx, ry):
 with open('gdrivesets/scenejson/{}.json'.format(datatype), 'rb') as f:
     dataset = json.load(f)
 
-if os.path.isfile('gdrivesets/fixationdata/{}_final.txt'.format(datatype)):
-    with open('gdrivesets/fixationdata/{}_final.txt'.format(datatype), 'rb') as f:
-        already_run = [a.split(' :: ')[0] for a in f.read().split('\n')]
-else:
-    already_run = []
+# S2b does not depend on the target, so it is shared by all the runs, and
+# the feedback of the targets is computed once for all the scenes
+session = Model1.SearchSession(s1filters, imgprots, objprots, targets, s2bcache=s2bcache)
 
-with open('gdrivesets/fixationdata/{}_final.txt'.format(datatype), 'ab') as f:
+# with a single target, results go to <datatype>_final.txt as before, and
+# to <datatype>_<target>_final.txt otherwise
+def results_filename(target):
+    if len(targets) == 1:
+        return 'gdrivesets/fixationdata/{}_final.txt'.format(datatype)
+    return 'gdrivesets/fixationdata/{}_{}_final.txt'.format(datatype, target)
+
+already_run = {}
+for target in targets:
+    if os.path.isfile(results_filename(target)):
+        with open(results_filename(target), 'rb') as f:
+            already_run[target] = [a.split(' :: ')[0] for a in f.read().split('\n')]
+    else:
+        already_run[target] = []
+
+outfiles = dict((target, open(results_filename(target), 'ab')) for target in targets)
+try:
     for name, position in dataset.iteritems():
         filename = 'gdrivesets/scenes/{}/{}'.format(datatype, name)
-        if not os.path.isfile(filename) or name in already_run:
+        torun = [target for target in targets if name not in already_run[target]]
+        if not os.path.isfile(filename) or len(torun) == 0:
             continue
         print '{} beginning'.format(name)
         fixations_allowed = int(name.split('_')[0][7:])
         img = scipy.misc.imread(filename, mode='I')
-        S1outputs = Model1.runS1layer(img, s1filters)
-        C1outputs = Model1.runC1layer(S1outputs)
-        print '  before s2b'
-        S2boutputs = Model1.runS2blayer(C1outputs, imgprots)
-        print '  after s2b'
-        feedback = Model1.feedbackSignal(objprots, targetIndex, objprots)
-        lipmap = Model1.topdownModulation(S2boutputs,feedback)
-        protID = np.argmax(feedback)
-
-        priorityMap = Model1.priorityMap(lipmap,[256,256])
-        print '  priority map created'
-        i = 0
-        found = False
-        while i < fixations_allowed and not found:
-            fx, fy = Model1.focus_location(priorityMap)
-            found = check_bounds(fx, fy, position[0], position[1])
-            if not found:
-                priorityMap, _, _ = Model1.inhibitionOfReturn(priorityMap)
-            i += 1
-        print '  {}'.format(i)
-        f.write('{} :: {} :: {}\n'.format(name, i, found))
-        print '{} completed'.format(name)
\ No newline at end of file
+        box_radius = (img.shape[1]/5.0)/2.0
+        searches = session.run(img, fixations_allowed)
+        print '  priority maps created'
+        for target, search in zip(targets, searches):
+            if target not in torun:
+                continue
+            i = 0
+            found = False
+            for fx, fy, _, _ in search:
+                i += 1
+                found = check_bounds(fx, fy, position[0], position[1], box_radius)
+                if found:
+                    break
+            print '  target {}: {}'.format(target, i)
+            outfiles[target].write('{} :: {} :: {}\n'.format(name, i, found))
+        print '{} completed'.format(name)
+finally:
+    for outfile in outfiles.values():
+        outfile.close()
\ No newline at end of file
@@ -2,6 +2,8 @@ import traceback
 import sys
 import cPickle
 import Model1
+import ModelStore1
+import ModelCache1
 import scipy.misc
 from scipy.ndimage.filters import gaussian_filter
 import numpy as np
@@ -13,6 +15,8 @@ import ModelOptions1 as opt
 
 reload(opt)
 reload(Model1) 
+reload(ModelStore1)
+reload(ModelCache1)
 
 beginning = 372
 change = 10
@@ -21,24 +25,21 @@ change = 10
 # Build filters
 s1filters = Model1.buildS1filters()
 print 'Loaded s1 filters'
-protsfile = open('imgprots.dat', 'rb')
-imgprots = cPickle.load(protsfile)#[beginning:beginning+change]
+imgprots = ModelStore1.loadPrototypes('imgprots.dat')#[beginning:beginning+change]
+imgprots = Model1.S2bProtIndex(imgprots)
+s2bcache = ModelCache1.S2bCache(s1filters, imgprots)
 print 'Loading objprots filters'
-protsfile = open('objprotsCorrect.dat', 'rb')
-# protsfile = open('resizedobjprots.dat', 'rb')
-objprots = cPickle.load(protsfile)
+objprots = ModelStore1.loadPrototypes('objprotsCorrect.dat')
+# objprots = ModelStore1.loadPrototypes('resizedobjprots.dat')
 for idx, _ in enumerate(objprots):
     objprots[idx] = objprots[idx]#[beginning:beginning+change]
 # objprots = objprots[0:-1] # NOTE THIS IS HACK because objprots was generated from a folder with 41 instead of 40 images. Getting rid of the last img.
 print 'Objprots shape:', len(objprots), objprots[0].shape
-protsfile = open('naturalImgC2b.dat', 'rb')
-imgC2b = cPickle.load(protsfile)
+imgC2b = ModelStore1.loadPrototypes('naturalImgC2b.dat')
 print 'imgC2b: ', len(imgC2b)
 imgC2b = imgC2b[0:-1]
-#with open('S3prots.dat', 'rb') as f:
-with open('resizeds3prots.dat', 'rb') as f:
-    #s3prots = cPickle.load(f)[:-1]
-    s3prots = cPickle.load(f)
+#s3prots = ModelStore1.loadPrototypes('S3prots.dat')[:-1]
+s3prots = Model1.S3ProtIndex(ModelStore1.loadPrototypes('resizeds3prots.dat'))
 print 'S3prots length: ', len(s3prots)
 #num_objs x num_scales x n x n x prototypes
 # Model1.buildS3Prots(1720,s1filters,imgprots)
@@ -87,7 +88,7 @@ img = scipy.misc.imread('example.png')
 # img = scipy.misc.imread('stimuli/1.array{}.ot.png'.format(stimnum))
 S1outputs = Model1.runS1layer(img, s1filters)
 C1outputs = Model1.runC1layer(S1outputs)
-S2boutputs = Model1.runS2blayer(C1outputs, imgprots)
+S2boutputs = s2bcache.getS2b(img)
 feedback = Model1.feedbackSignal(objprots, targetIndex, imgC2b)
 print 'feedback info: ', feedback.shape
 lipmap = Model1.topdownModulation(S2boutputs,feedback)
@@ -95,7 +96,7 @@ protID = np.argmax(feedback)
 print feedback[protID], np.mean(feedback)
 print 'lipmap shape: ', len(lipmap), lipmap[0].shape
 
-priorityMap = Model1.priorityMap(lipmap, opt.IMGSIZE)
+priorityMap = Model1.priorityMap(lipmap, img.shape)
 
 # i = 0
 # found = False
@@ -0,0 +1,58 @@
+import unittest
+import math
+import numpy as np
+import scipy.misc as sm
+from scipy import stats
+import Model1
+import ModelOptions1 as opt
+
+# The windowed inhibition of return (Model1.suppressFocus(), IORMap and
+# fixations()) must give the same fixations as the original full-map
+# inhibitionOfReturn() loop, ties included:
+#   python -m unittest test_ior
+
+def referenceFixations(prio, nbfixations):
+	'''
+	Fixations of the original model: the focus is the first maximum of the
+	map in row-major order, then the whole map is multiplied by
+	1 - GAUSSFACTOR * gauss_2d()
+	'''
+	grid_y, grid_x = np.mgrid[:prio.shape[0], :prio.shape[1]]
+	result = []
+	for n in range(nbfixations):
+		relative_focus = np.argmax(prio)
+		focus_y = math.floor(relative_focus/prio.shape[1])
+		focus_x = relative_focus % prio.shape[1]
+		result.append((int(focus_x), int(focus_y)))
+		g = (1.0 - opt.GAUSSFACTOR*(stats.norm.pdf(grid_x, focus_x, opt.IORSIGMA) * stats.norm.pdf(grid_y, focus_y, opt.IORSIGMA)))
+		prio = prio * g
+	return result, prio
+
+class IORTest(unittest.TestCase):
+
+	def compareFixations(self, prio, nbfixations):
+		expected, _ = referenceFixations(prio, nbfixations)
+		fixations = [(int(x), int(y)) for x, y, _, _ in Model1.fixations(prio, nbfixations)]
+		self.assertEqual(fixations, expected)
+
+	def test_example(self):
+		# A real image has many exact ties
+		self.compareFixations(sm.imread('example.png').astype(float), 30)
+
+	def test_blocky(self):
+		# Every value is repeated over an 8x8 block
+		rng = np.random.RandomState(0)
+		for n in range(30):
+			self.compareFixations(np.kron(rng.rand(32, 32), np.ones((8, 8))), 20)
+
+	def test_nonsquare(self):
+		self.compareFixations(np.random.RandomState(1).rand(100, 300), 20)
+
+	def test_inhibition(self):
+		prio = np.random.RandomState(2).rand(256, 256)
+		_, expected = referenceFixations(prio, 1)
+		inhibited, _, _ = Model1.inhibitionOfReturn(prio)
+		self.assertTrue(np.array_equal(inhibited, expected))
+
+if __name__ == '__main__':
+	unittest.main()
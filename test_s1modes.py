@@ -0,0 +1,86 @@
+import unittest
+import numpy as np
+import scipy.ndimage.filters as snf
+import Model1
+import ModelOptions1 as opt
+
+# Both S1 modes (see Model1.runS1layer()) must give the same output as the
+# original per-filter S1 and C1 layers, and as each other:
+#   python -m unittest test_s1modes
+
+def referenceS1(img, s1filters):
+	'''
+	The original S1 layer: one fft convolution per filter, normalized at full
+	resolution, then strided
+	'''
+	img = img.astype(float)
+	output = []
+	for fthisscale in s1filters:
+		RFSIZE = fthisscale[0].shape[0]
+		stride = int(np.round(RFSIZE/4.0))
+		tmp = snf.uniform_filter(img**2, RFSIZE)*RFSIZE*RFSIZE
+		tmp[tmp<0] = 0.0
+		normim = np.sqrt(tmp) + 1e-9 + opt.SIGMAS1
+		outputsAllOrient = []
+		for o in range(0,4):
+			tmp = np.fft.irfft2(np.fft.rfft2(img) * np.fft.rfft2(fthisscale[o], img.shape))
+			tmp = np.roll(np.roll(tmp,-(RFSIZE/2), axis=1),-(RFSIZE/2), axis=0)
+			tmp /= normim
+			outputsAllOrient.append(tmp[::stride,::stride])
+		output.append(np.dstack(outputsAllOrient))
+	return output
+
+def referenceC1(S1outputs):
+	'''
+	The original C1 layer: every other S1 sample, then a max filter per 
+	orientation
+	'''
+	return [np.dstack([snf.maximum_filter(S1thisscale[::2,::2,p], size=opt.C1RFSIZE) 
+		for p in range(S1thisscale.shape[2])]) for S1thisscale in S1outputs]
+
+class S1ModesTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.s1filters = Model1.S1FilterBank(Model1.buildS1filters())
+
+	def compareModes(self, shape):
+		img = np.random.RandomState(0).rand(*shape) * 255
+		S1reference = referenceS1(img, self.s1filters)
+		C1reference = referenceC1(S1reference)
+		for mode in ['fft', 'strided']:
+			S1outputs = Model1.runS1layer(img, self.s1filters, mode)
+			C1outputs = Model1.runS1C1layers(img, self.s1filters, mode)
+			for scaleidx in range(len(S1reference)):
+				self.assertTrue(np.allclose(S1outputs[scaleidx], S1reference[scaleidx], rtol=0, atol=1e-10),
+					'S1 scale %d of a %s image (%s): differs from the original' % (scaleidx, shape, mode))
+				self.assertTrue(np.allclose(C1outputs[scaleidx], C1reference[scaleidx], rtol=0, atol=1e-10),
+					'C1 scale %d of a %s image (%s): differs from the original' % (scaleidx, shape, mode))
+		for c1grid in [False, True]:
+			ffts = Model1.runS1layer(img, self.s1filters, 'fft', c1grid)
+			strided = Model1.runS1layer(img, self.s1filters, 'strided', c1grid)
+			for scaleidx, (a, b) in enumerate(zip(ffts, strided)):
+				self.assertEqual(a.shape, b.shape)
+				self.assertTrue(np.allclose(a, b, rtol=0, atol=1e-10),
+					'S1 scale %d of a %s image (c1grid=%s): max difference %g' % (scaleidx, shape, c1grid, np.max(np.abs(a - b))))
+		# runS1C1layers() reads the strided samples on the C1 grid only
+		c1 = Model1.runC1layer(Model1.runS1layer(img, self.s1filters, 'fft'))
+		for a, b in zip(c1, Model1.runS1C1layers(img, self.s1filters, 'strided')):
+			self.assertTrue(np.allclose(a, b, rtol=0, atol=1e-10))
+
+	def test_small(self):
+		# Smaller than the largest filters, which are truncated
+		self.compareModes((20, 20))
+
+	def test_44(self):
+		self.compareModes((44, 44))
+
+	def test_256(self):
+		self.compareModes((256, 256))
+
+	def test_nonsquare(self):
+		self.compareModes((40, 70))
+		self.compareModes((10, 12))
+
+if __name__ == '__main__':
+	unittest.main()